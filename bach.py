@@ -1,13 +1,68 @@
 import os
+import sys
+import math
+import time
+import mmap
+import errno
 import pickle
-import copy
-from random import random, choice
-from music21 import *
+import random as _random
+import heapq
+import hashlib
+import struct
+import argparse
+import importlib
+import multiprocessing
+from random import random
+from bisect import bisect_left,bisect_right
+from array import array
+
+class _lazy_module(object):
+    '''
+    Stands in for a music21 module, importing it the first time one of its
+    attributes is used. Importing music21 takes seconds, and generating from
+    a saved model with gen_melodies, iter_melody and the event writers never
+    needs it, so it is only imported for parsing chorales, building music21
+    streams and harmonising
+    '''
+    
+    def __init__(self,name):
+        self._name = name
+        self._module = None
+        
+    def __getattr__(self,attr):
+        if self._module == None:
+            self._module = importlib.import_module('music21.' + self._name)
+            
+        return getattr(self._module,attr)
+
+base = _lazy_module('base')
+clef = _lazy_module('clef')
+converter = _lazy_module('converter')
+corpus = _lazy_module('corpus')
+duration = _lazy_module('duration')
+interval = _lazy_module('interval')
+note = _lazy_module('note')
+pitch = _lazy_module('pitch')
+stream = _lazy_module('stream')
 
 '''
 CONSTANTS
 '''
 CURRENT_VERSION = 1.0
+EXTRACTOR_VERSION = 2.1
+
+FEATURE_CACHE_DIR = 'feature_cache'
+MODEL_STORE_DIR = 'models'
+MODEL_LOCK_TIMEOUT = 3600
+SCORE_EXTENSIONS = ['.xml','.mxl','.musicxml','.mid','.midi','.krn','.abc']
+
+# A binary model file starts with the magic bytes, the format version and the length
+# of the pickled metadata that follows. The int32 arrays of the model come after the
+# metadata, little endian and aligned to BINARY_MODEL_ALIGNMENT bytes
+BINARY_MODEL_MAGIC = b'BACHMODL'
+BINARY_MODEL_VERSION = 1
+BINARY_MODEL_HEADER = '<8sII'
+BINARY_MODEL_ALIGNMENT = 8
 
 LOWEST_PITCH = 40
 HIGHEST_PITCH = 84
@@ -20,10 +75,50 @@ RANGES[TENOR] = range(50,65)
 RANGES[ALTO] = range(60,75)
 RANGES[SOPRANO] = range(62,HIGHEST_PITCH+1)
 
+NULL_ID = 0
+REST_MIDI = -1
+REACH_HORIZON = 64
+TICKS_PER_QUARTER = 480
+MAX_SEED = 2**31 - 1
+
+PITCH_NAMES = ['C','C#','D','E-','E','F','F#','G','G#','A','B-','B']
+PITCH_CLASSES = {'C':0,'D':2,'E':4,'F':5,'G':7,'A':9,'B':11}
+PITCH_STEPS = ['C','D','E','F','G','A','B']
+
+# Sets of pitch classes are kept as 12 bit masks with bit n set for pitch class n.
+# PITCH_CLASS_BITS gives the bit of each midi number and PITCH_CLASS_COUNTS the
+# number of pitch classes in each mask
+PITCH_CLASS_BITS = [1 << (x%12) for x in range(128)]
+PITCH_CLASS_COUNTS = [bin(x).count('1') for x in range(1 << 12)]
+
+# PERFECT_INTERVALS[abs(a-b)] is True if midi numbers a and b are a perfect unison,
+# fourth, fifth or octave apart, or a compound of one. VOICE_PAIRS are the pairs of
+# parts checked for parallel motion
+PERFECT_INTERVALS = [(x%12) in (0,5,7) for x in range(128)]
+VOICE_PAIRS = [(part,other_part) for part in range(4) for other_part in range(part+1,4)]
+
+VOICE_NAMES = ['Bass','Alto','Tenor','Soprano']
+SCORE_ORDER = [SOPRANO,ALTO,TENOR,BASS]
+TREBLE_VOICES = [SOPRANO,ALTO]
+MIDI_TEMPO = 120
+MIDI_VELOCITY = 64
+BEATS_PER_MEASURE = 4
+
+# MusicXML note type and number of dots of each duration in ticks (TICKS_PER_QUARTER = 480)
+MUSICXML_NOTE_TYPES = {1920:('whole',0),960:('half',0),480:('quarter',0),240:('eighth',0),
+                       120:('16th',0),60:('32nd',0),1440:('half',1),720:('quarter',1),
+                       360:('eighth',1),180:('16th',1),90:('32nd',1)}
+
+# Voice ranges worked out by _get_voice_options
+_voice_options = {}
+
+# The model of a process harmonising melodies for gen_harmonies
+_harmony_worker = {}
+
 '''
 PUBLIC FUNCTIONS
 '''
-def gen_model(chord_order,pitch_order,offset_order):
+def gen_model(chord_order,pitch_order,offset_order,workers=1,feature_cache=FEATURE_CACHE_DIR,model_dir=MODEL_STORE_DIR,stats=None):
     '''
     Builds a model based on Bach's chorales that are included
     as a part of music21.
@@ -34,46 +129,199 @@ def gen_model(chord_order,pitch_order,offset_order):
         chord_order: order of the markov model for the chord progression
         pitch_order: order of the markov model for the melody pitches
         offset_order: order of the markov model for rhythm in the form of offsets
+        workers: number of processes used to parse the chorales. If workers > 1
+                 each process builds a partial model from a share of the chorales
+                 and the partial models are merged into one. The merged model is
+                 identical to the one built by a single process
+        feature_cache: directory in which the sequences extracted from each chorale
+                       are cached, keyed by BWV number and EXTRACTOR_VERSION. Models
+                       of any order are counted from the cached sequences without
+                       parsing the chorales again. If None no cache is used
+        model_dir: directory of the model_store in which built models are saved
+        stats: optional generation_stats. If given, the time taken to add each
+               chorale is recorded in it rather than printed
     
     RETURNS:
         A model object encapsulating the three markov models
     '''
     bcl = corpus.chorales.ChoraleList()
     bwv = bcl.byBWV
+    bwv_nums = [bwv[key]['bwv'] for key in bwv.keys()]
+    store = model_store(model_dir)
+    
     model = chorale_model(chord_order,pitch_order,offset_order)
+    model.manifest = _get_corpus_manifest(bwv_nums)
     
-    saved_model = _check_if_model_saved(model)
+    if model.load_model(store=store):
+        return model
     
-    if not saved_model:
-        for key in bwv.keys():
-            stream = corpus.parse('bach/bwv' + str(bwv[key]['bwv']))
-            print 'Now parsing: ' + 'bach/bwv' + str(bwv[key]['bwv'])
-            model.add_melody_pitches_to_model(stream)
-            model.add_melody_offsets_to_model(stream)
-            model.add_chords_to_model(stream)
-            
-        model.save_model()
-            
-    else:
-        if not model.load_model(saved_model):
-            for key in bwv.keys():
-                stream = corpus.parse('bach/bwv' + str(bwv[key]['bwv']))
-                print 'Now parsing: ' + 'bach/bwv' + str(bwv[key]['bwv'])
-                model.add_melody_pitches_to_model(stream)
-                model.add_melody_offsets_to_model(stream)
-                model.add_chords_to_model(stream)
-                
-            model.save_model()
+    # Another process may be building the same model. Wait for it and
+    # load its model rather than building a duplicate
+    store.lock(model.get_model_key())
+    try:
+        if not model.load_model(store=store):
+            model = chorale_model(chord_order,pitch_order,offset_order)
+            model.manifest = _get_corpus_manifest(bwv_nums)
+            model = _build_model(model,bwv_nums,workers,feature_cache,stats)
+            model.save_model(store)
+    finally:
+        store.unlock(model.get_model_key())
+        
+    return model
+
+def gen_multi_order_model(max_chord_order,max_pitch_order,max_offset_order,workers=1,feature_cache=FEATURE_CACHE_DIR,stats=None):
+    '''
+    Builds a model containing every order up to the given maximum orders
+    in a single pass over the chorales
+    
+    INPUTS:
+        max_chord_order: highest order of the chord markov model
+        max_pitch_order: highest order of the melody pitch markov model
+        max_offset_order: highest order of the melody offset markov model
+        workers: number of processes used to parse the chorales (see gen_model)
+        feature_cache: directory of cached chorale sequences (see gen_model)
+        stats: optional generation_stats (see gen_model)
+    
+    RETURNS:
+        A multi_order_model object. Its get_model method returns a model
+        of any order up to the maximum orders that can be passed to
+        gen_melody and gen_harmony
+    '''
+    bcl = corpus.chorales.ChoraleList()
+    bwv = bcl.byBWV
+    bwv_nums = [bwv[key]['bwv'] for key in bwv.keys()]
+    model = multi_order_model(max_chord_order,max_pitch_order,max_offset_order)
+    model.manifest = _get_corpus_manifest(bwv_nums)
+    
+    return _build_model(model,bwv_nums,workers,feature_cache,stats)
+
+def merge(models):
+    '''
+    Sums the counts of a list of models with the same orders. The counts of the
+    markov models are purely additive, so the result is the model that would
+    have been built from the chorales and scores of all of the models together
+    
+    INPUTS:
+        models: list of chorale_models or compact_chorale_models
+        
+    RETURNS:
+        A new chorale_model whose manifest joins the manifests of the models
+        
+        If the orders of the models differ merge returns
+        None and prints an error
+    '''
+    models = [x.to_chorale_model() if isinstance(x,compact_chorale_model) else x for x in models]
+    orders = set([(x.chord_order,x.melody_pitch_order,x.melody_offset_order) for x in models])
+    
+    if len(orders) != 1:
+        print 'Unable to merge models of different orders'
+        return None
+        
+    merged_model = chorale_model(*orders.pop())
+    for model in models:
+        merged_model.merge_model(model)
+        merged_model.manifest = merged_model.manifest + list(model.manifest)
+        
+    return merged_model
+
+def open_model(filename):
+    '''
+    Opens a saved model, either a binary model written by save_binary or a
+    pickle file written by save_model, the legacy format
+    
+    INPUTS:
+        filename: file of the saved model
+        
+    RETURNS:
+        A compact_chorale_model for a binary model or a chorale_model for
+        a pickle file, or None if the model could not be loaded
+    '''
+    if _is_binary_model(filename):
+        return open_binary_model(filename)
+        
+    model = chorale_model(0,0,0)
+    if not model.load_model(filename=filename):
+        return None
+        
+    return model
+
+def open_binary_model(filename):
+    '''
+    Opens a model saved with save_binary. The file is mapped into memory with
+    mmap and the transition tables are read in place, so opening a model takes
+    the same short time whatever its size and processes that open the same file
+    share its pages through the page cache. A model opened in one process can
+    be passed to worker processes, which map the file again rather than copy it
+    
+    INPUTS:
+        filename: file of the binary model
+        
+    RETURNS:
+        A compact_chorale_model whose tables are read from the file
+        
+        If the file is not a binary model or was written in another version
+        of the format open_binary_model returns None and prints an error
+    '''
+    try:
+        model_file = _model_file(filename)
+        buffer = model_file.buffer
+        header_size = struct.calcsize(BINARY_MODEL_HEADER)
+        (magic,version,metadata_length) = struct.unpack_from(BINARY_MODEL_HEADER,buffer,0)
+    except (EnvironmentError,ValueError,struct.error):
+        print 'Error reading from ' + str(filename)
+        return None
+        
+    if magic != BINARY_MODEL_MAGIC:
+        print 'Not a binary model: ' + str(filename)
+        return None
+        
+    if version != BINARY_MODEL_VERSION:
+        print 'Unsupported binary model version ' + str(version) + ' in ' + str(filename)
+        return None
+        
+    metadata = pickle.loads(buffer[header_size:header_size + metadata_length])
+    offset = _align(header_size + metadata_length)
+    arrays = {}
+    
+    for (name,length) in metadata['arrays']:
+        arrays[name] = _mapped_array(model_file,offset,length)
+        offset += 4*length
+        
+    if offset > len(buffer):
+        print 'Binary model is truncated: ' + str(filename)
+        return None
+        
+    (c_order,m_p_order,m_o_order) = metadata['orders']
+    model = compact_chorale_model(c_order,m_p_order,m_o_order)
+    model.manifest = list(metadata['manifest'])
+    for element in metadata['vocabulary'][NULL_ID+1:]:
+        model.vocabulary.intern(element)
+        
+    model.melody_pitch_model = _get_mapped_markov(arrays,'melody_pitch_model',m_p_order)
+    model.melody_offset_model = _get_mapped_markov(arrays,'melody_offset_model',m_o_order)
+    model.chord_model = _get_mapped_markov(arrays,'chord_model',c_order)
+    model.chord_weights = _get_mapped_markov(arrays,'chord_weights',0)
+    model.chord_table = metadata.get('chord_table',{})
+    _update_chord_table(model.chord_table,model.vocabulary.elements)
+    
+    # The reachability tables depend on the horizon they were computed for
+    if metadata['horizon'] == REACH_HORIZON:
+        for (name,constraint,array_name) in metadata['reach']:
+            if constraint != None:
+                constraint = frozenset(constraint)
+            model.reach_tables.append((name,constraint,arrays[name + '.next_rows'],arrays[array_name]))
         
     return model
 
-def gen_melody(model,melody_len):
+def gen_melody(model,melody_len,stats=None):
     '''
     Generates a melody based on a model object.
     
     INPUTS:
         model: A model as generated by parse_bach
         melody_len: The desired length in notes of the melody
+        stats: optional generation_stats in which the time spent sampling and
+               building the stream and the number of retries are recorded
         
     RETURNS:
         A music21 Score opbject with a single part
@@ -82,27 +330,39 @@ def gen_melody(model,melody_len):
         the specified length, gen_melody will return None
         and print an error
     '''
-    pitch_constraint = [str(pitch.Pitch(x)) for x in RANGES[SOPRANO]]
-    melody_pitches = _gen_melody_component(model.melody_pitch_model,model.melody_pitch_order,melody_len,pitch_constraint)
+    start_time = time.time()
+    samplers = model.get_samplers()
+    
+    pitch_constraint = samplers['vocabulary'].get_id_set([str(pitch.Pitch(x)) for x in RANGES[SOPRANO]])
+    melody_pitches = _gen_melody_component(samplers['melody_pitch'],model.melody_pitch_order,melody_len,pitch_constraint)
     
     count = 0
     while (melody_pitches == None):
-        melody_pitches = _gen_melody_component(model.melody_pitch_model,model.melody_pitch_order,melody_len,pitch_constraint)
-        count += 1
-        
         if (count >= 1000):
             print 'Unable to generate specified melody'
+            return None
+            
+        melody_pitches = _gen_melody_component(samplers['melody_pitch'],model.melody_pitch_order,melody_len,pitch_constraint)
+        count += 1
+            
+    if stats != None:
+        stats.add_count('melody_pitch_retries',count)
         
     offset_constraint = None
-    melody_offsets = _gen_melody_component(model.melody_offset_model,model.melody_offset_order,melody_len,offset_constraint)
+    melody_offsets = _gen_melody_component(samplers['melody_offset'],model.melody_offset_order,melody_len,offset_constraint)
     
     count = 0
     while (melody_offsets == None):
-        melody_offsets = _gen_melody_component(model.melody_offset_model,model.melody_offset_order,melody_len,offset_constraint)
-        count += 1
-        
         if (count >= 1000):
             print 'Unable to generate specified melody'
+            return None
+            
+        melody_offsets = _gen_melody_component(samplers['melody_offset'],model.melody_offset_order,melody_len,offset_constraint)
+        count += 1
+            
+    if stats != None:
+        stats.add_count('melody_offset_retries',count)
+        start_time = stats.add_time('sampling',start_time)
     
     melody_durations = _get_melody_durations(melody_offsets)
     melody = zip(melody_pitches,melody_durations)
@@ -119,483 +379,2424 @@ def gen_melody(model,melody_len):
         n.duration = duration.Duration(melody_duration)
         soprano.append(n)
         
+    if stats != None:
+        stats.add_time('stream_building',start_time)
+        
     return soprano
-    
-def gen_harmony(melody,model):
+
+def gen_melodies(model,n,melody_len):
     '''
-    Generates a four part harmony for a given melody using a model
+    Generates many melodies at once. The markov chains of all the melodies are
+    advanced together and the melodies are returned as arrays of integers, so
+    music21 streams need only be built for the melodies that are kept.
     
     INPUTS:
-        melody: music21 Score object containing one part
-        model: A model as generated by parse_bach
+        model: A model as generated by gen_model
+        n: The number of melodies to generate
+        melody_len: The desired length in notes of each melody
         
     RETURNS:
-        A music21 Score object with four parts in harmony
+        A tuple (pitches,durations) of arrays holding the melodies one after the
+        other, so that melody i is pitches[i*melody_len:(i+1)*melody_len] and
+        durations[i*melody_len:(i+1)*melody_len]. Pitches are midi numbers (REST_MIDI
+        for a rest) and durations are in ticks of TICKS_PER_QUARTER to the quarter
+        note. melody_to_stream builds a music21 stream from one melody
         
-        If build_harmony is unable to generate a harmony
-        from a given melody, build_harmony will return None
-        and print an error
+        If a melody cannot be generated after 1000 attempts gen_melodies
+        returns None and prints an error
     '''
-    chord_model = model.chord_model
-    chord_model_order = model.chord_order
-    chord_model_weights = model.chord_weights[()]
+    samplers = model.get_samplers()
+    vocabulary = samplers['vocabulary']
     
-    [chord_prog_pitches,harmony_durations] = _gen_chord_prog(melody,chord_model,chord_model_order,chord_model_weights)
-
-    harmony_pitches = []
+    pitch_constraint = vocabulary.get_id_set([_midi_to_pitch_name(x) for x in RANGES[SOPRANO]])
+    pitch_ids = _gen_melody_components(samplers['melody_pitch'],model.melody_pitch_order,n,melody_len,pitch_constraint)
     
-    for (melody_note,chord) in zip(melody.notes,chord_prog_pitches):
-        if len(harmony_pitches) == 0:
-            prev_harmony = []
-        else:
-            i = -1
-            prev_harmony = harmony_pitches[i]
-            
-            while (prev_harmony == 'REST'):
-                i -= 1
-                if (i >= len(harmony_pitches)):
-                    prev_harmony = []
-                    break
-                else:
-                    prev_harmony = harmony_pitches[i]
-            
-        if chord == 'REST':
-            harmony_pitches.append(['REST','REST','REST','REST'])
-        else:
-            next_harmony = _get_next_harmony(prev_harmony,melody_note.pitch,chord)
-            
-            i = 0
-            while (next_harmony == None):
-                next_harmony = _get_next_harmony(prev_harmony,melody_note.pitch,chord)
-                i += 1
-                if i > 1000:
-                    print 'Unable to realize harmony with given melody'
-                    return
-                    
-            harmony_pitches.append(next_harmony)
-
-    harmony_score = stream.Stream()
-    bass_tenor_alto_streams = [stream.Part(),stream.Part(),stream.Part()]
+    # One more offset than notes gives a duration for the last note
+    offset_ids = _gen_melody_components(samplers['melody_offset'],model.melody_offset_order,n,melody_len+1,None)
     
-    for (chord,chord_duration) in zip(harmony_pitches,harmony_durations):
-        for (pitch,s) in zip(chord,bass_tenor_alto_streams):
-            if pitch == 'REST':
-                n = note.Rest()
-            else:
-                n = note.Note(pitch)
-                
-            n.duration = duration.Duration(chord_duration)
-            s.append(n)
+    if (pitch_ids == None) or (offset_ids == None):
+        print 'Unable to generate specified melody'
+        return None
         
-    t_clef = clef.TrebleClef()
-    b_clef = clef.BassClef()
-    t_clef.offset = 0.0
-    b_clef.offset = 0.0
+    midi_table = _get_midi_table(vocabulary)
+    pitches = array('h',[midi_table[x] for x in pitch_ids])
+    durations = array('i')
     
-    melody.insert(0,t_clef)
-    bass_tenor_alto_streams[2].insert(0,t_clef)
-    bass_tenor_alto_streams[1].insert(0,b_clef)
-    bass_tenor_alto_streams[0].insert(0,b_clef)
+    for i in range(n):
+        melody_offsets = [vocabulary.elements[x] for x in offset_ids[i*(melody_len+1):(i+1)*(melody_len+1)]]
+        for melody_duration in _get_melody_durations(melody_offsets):
+            durations.append(int(round(melody_duration*TICKS_PER_QUARTER)))
+            
+    return (pitches,durations)
+
+def melody_to_stream(pitches,durations):
+    '''
+    Returns a music21 Stream of one melody given as midi numbers and durations
+    in ticks, as returned by gen_melodies
+    '''
+    soprano = stream.Stream()
     
-    harmony_score.insert(0,melody)
-    harmony_score.insert(0,bass_tenor_alto_streams[2])
-    harmony_score.insert(0,bass_tenor_alto_streams[1])
-    harmony_score.insert(0,bass_tenor_alto_streams[0])
+    for (melody_pitch,melody_duration) in zip(pitches,durations):
+        if melody_pitch == REST_MIDI:
+            n = note.Rest()
+        else:
+            n = note.Note(pitch.Pitch(_midi_to_pitch_name(melody_pitch)))
+            
+        n.duration = duration.Duration(float(melody_duration)/TICKS_PER_QUARTER)
+        soprano.append(n)
         
-    return _smooth_harmony(harmony_score)
+    return soprano
     
-'''
-PRIVATE FUNCTIONS
-'''
-def _gen_melody_component(element_model,model_order,melody_len,constraint):
+def iter_melody(model,melody_len=None):
     '''
-    Generates a component of the melody i.e. the melody pitches
-    or the melody offsets
+    Generates a melody one note at a time. Only the current states of the
+    markov chains are kept, so the melody can be of any length.
     
     INPUTS:
-        element_model: markov model for the given element
-        model_order: order of element markov model
-        melody_len: desired length of melody
-        constrain: the set of possible options for an element in the melody
-                   If constraint == None there is no restriction on what
-                   elements can be in the melody
+        model: A model as generated by gen_model
+        melody_len: The length in notes of the melody. If melody_len == None
+                    the melody never ends
         
-    RETURNS:
-        A list of elements as generated by the element markov model
+    YIELDS:
+        (pitch,duration) for each note where pitch is a midi number (REST_MIDI
+        for a rest) and duration is in ticks of TICKS_PER_QUARTER to the quarter
+        note. When a markov chain reaches the end of a chorale it starts again
+        from the beginning of a chorale
     '''
-    melody_elements = []
-    count = 0
+    samplers = model.get_samplers()
+    vocabulary = samplers['vocabulary']
+    midi_table = _get_midi_table(vocabulary)
     
-    element_buff = tuple(['NULL' for x in range(model_order)])
-    next_element = _get_next_element(element_model[element_buff])
+    pitch_constraint = vocabulary.get_id_set([_midi_to_pitch_name(x) for x in RANGES[SOPRANO]])
+    melody_pitches = _iter_melody_component(samplers['melody_pitch'],model.melody_pitch_order,pitch_constraint)
+    melody_offsets = _iter_melody_component(samplers['melody_offset'],model.melody_offset_order,None,True)
     
-    if constraint != None:
-        i = 0
-        while next_element not in constraint:
-            next_element = _get_next_element(element_model[element_buff])
-            i += 1
-            if i > 100:
-                return None
-    else:
-        next_element = _get_next_element(element_model[element_buff])
+    # The duration of a note is the distance to the offset of the next note of the
+    # same chain. The last note of a chain that reaches the end of a chorale is given
+    # the duration of the note before it, as the chain starts again from offset 0
+    next_offset = vocabulary.elements[next(melody_offsets)]
+    prev_duration = None
+    count = 0
     
-    while (count < melody_len):
-        melody_elements.append(next_element)
-
-        element_buff = element_buff[1:] + (next_element,)
-        next_element = _get_next_element(element_model[element_buff])
+    while (melody_len == None) or (count < melody_len):
+        melody_offset = next_offset
+        next_id = next(melody_offsets)
         
-        if constraint != None:
-            i = 0
-            while next_element not in constraint:
-                next_element = _get_next_element(element_model[element_buff])
-                i += 1
-                if i > 100:
-                    return None
+        if next_id == NULL_ID:
+            next_offset = vocabulary.elements[next(melody_offsets)]
+            if prev_duration != None:
+                melody_duration = prev_duration
+            else:
+                melody_duration = 1.0
+            prev_duration = None
         else:
-            next_element = _get_next_element(element_model[element_buff])
+            next_offset = vocabulary.elements[next_id]
+            melody_duration = _get_melody_durations([melody_offset,next_offset])[0]
+            prev_duration = melody_duration
             
+        yield (midi_table[next(melody_pitches)],int(round(melody_duration*TICKS_PER_QUARTER)))
         count += 1
 
-        if (next_element == 'NULL'):
-            return None
-            
-    return melody_elements
-
-def _get_melody_durations(melody_offsets):
-    '''
-    Returns a list of note durations (quarter note, half note, etc.) 
-    given a list of note offsets
+def iter_harmony(model,melody_events,lookahead=4):
     '''
-    melody_durations = []
-    
-    for i in range(len(melody_offsets)-1):
-        offset_delta = melody_offsets[i+1] - melody_offsets[i]
-
-        if offset_delta < 0.0:
-            offset_delta = (4 - melody_offsets[i]) + melody_offsets[i+1]
-
-        melody_durations.append(offset_delta)
-        
-    return melody_durations
+    Generates a four part harmony for a melody one chord at a time.
     
-def _gen_chord_prog(melody,chord_model,chord_model_order,chord_weights):
-    '''
-    Returns a list of chords that form a chord progression to match the melody
+    The voicing of each chord is chosen by finding the best voicings of it and
+    the following lookahead chords (see _find_voicings), so at most lookahead
+    chords are held back and the melody can be of any length. If the chords
+    in the window cannot follow the previous voicing the voice leading starts
+    again from the current chord.
     
     INPUTS:
-        melody: melody on which the chord progression is based
-        chord_model: markov model for chord progressions
-        chord_model_order: order of chord markov model
-        chord_weights: A dictionary of all chords used in the chord markov model
-                       with the chords as keys and the frequency of use as values.
-                       This is used as a fallback when the markov model is unable
-                       to produce a chord for a given note in the melody
-    
-    RETURNS:
-        list of chords where a chord is a tuple of notes eg. ('A','C','E')
+        model: A model as generated by gen_model
+        melody_events: iterable of (pitch,duration) as yielded by iter_melody
+        lookahead: number of following chords considered when voicing a chord
+        
+    YIELDS:
+        (voicing,duration) for each note of the melody where voicing is a tuple of
+        midi numbers indexed by BASS, ALTO, TENOR and SOPRANO, all REST_MIDI for a
+        rest, and duration is in ticks
+        
+        If the melody cannot be harmonised iter_harmony prints an
+        error and stops
     '''
-    chord_prog = []
-    chord_durations = []
-
-    melody_pitches = melody.flat.notesAndRests
-    chord_buff = tuple(['NULL' for x in range(chord_model_order)])
+    samplers = model.get_samplers()
+    chord_index = samplers['chord']
+    chord_table = samplers['chord_table']
+    chord_buff = tuple([NULL_ID for x in range(model.chord_order)])
     
-    for pitch in melody_pitches:
-        if not pitch.isRest:
-            if chord_buff in chord_model.keys():
-                next_chord = _get_next_chord(pitch,chord_model[chord_buff],chord_weights)
-            else:
-                next_chord = _get_next_chord(pitch,chord_weights,chord_weights)
-            if next_chord != 'NULL':
-                chord_prog.append(next_chord)
-                chord_durations.append(pitch.duration.quarterLength)
+    window = []
+    num_chords = 0
+    prev_voicing = None
+    
+    for (soprano_midi,melody_duration) in melody_events:
+        if soprano_midi == REST_MIDI:
+            window.append((None,None,melody_duration))
+        else:
+            next_chord = chord_index.draw(chord_buff,soprano_midi%12)
+            if next_chord == None:
+                print 'Unable to realize harmony with given melody'
+                return
                 
             chord_buff = chord_buff[1:] + (next_chord,)
+            window.append((chord_index.vocabulary.elements[next_chord],soprano_midi,melody_duration))
+            num_chords += 1
+            
+        if num_chords <= lookahead:
+            continue
+            
+        voicings = _voice_window(window,prev_voicing,chord_table)
+        if voicings == None:
+            print 'Unable to realize harmony with given melody'
+            return
+            
+        while window[0][0] == None:
+            yield ((REST_MIDI,REST_MIDI,REST_MIDI,REST_MIDI),window.pop(0)[2])
+            
+        (chord_notes,soprano_midi,melody_duration) = window.pop(0)
+        prev_voicing = voicings[0]
+        num_chords -= 1
+        yield (prev_voicing,melody_duration)
+        
+    voicings = _voice_window(window,prev_voicing,chord_table)
+    if voicings == None:
+        print 'Unable to realize harmony with given melody'
+        return
+        
+    for (chord_notes,soprano_midi,melody_duration) in window:
+        if chord_notes == None:
+            yield ((REST_MIDI,REST_MIDI,REST_MIDI,REST_MIDI),melody_duration)
+        else:
+            yield (voicings.pop(0),melody_duration)
 
-        elif pitch.isRest:
-            chord_prog.append(['REST'])
-            chord_durations.append(pitch.duration.quarterLength)
-
-    return [chord_prog,chord_durations]
-    
-def _get_next_chord(pitch,chord_model_state,chord_weights):
+def gen_harmony(melody,model,stats=None):
     '''
-    Returns a chord given melody pitch and model state
+    Generates a four part harmony for a given melody using a model
+    
+    INPUTS:
+        melody: music21 Score object containing one part
+        model: A model as generated by parse_bach
+        stats: optional generation_stats in which the time spent on each step,
+               the number of failures and the number of chords drawn from the
+               chord weights rather than the chord model are recorded
+        
+    RETURNS:
+        A music21 Score object with four parts in harmony
+        
+        If build_harmony is unable to generate a harmony
+        from a given melody, build_harmony will return None
+        and print an error
     '''
-    constrained_model = {next_state:chord_model_state[next_state] for next_state in chord_model_state.keys() if pitch.name in next_state}
-    if len(constrained_model.keys()) == 0:
-        constrained_model = {next_state:chord_weights[next_state] for next_state in chord_weights.keys() if pitch.name in next_state}
+    harmony = _harmonise(_get_melody_notes(melody),model,stats)
+    if harmony == None:
+        return None
         
-    next_element = _get_next_element(constrained_model)
-    return next_element
+    start_time = time.time()
+    harmony_score = _harmony_to_score(melody,harmony)
     
-def _get_next_harmony(prev_harmony,melody_pitch,chord_notes):
+    if stats != None:
+        stats.add_time('stream_building',start_time)
+        
+    return harmony_score
+
+def gen_harmonies(melodies,model,workers=1,seed=None,stats=None):
     '''
-    Assigns pitches to each voice to create a single harmony given a previous harmony.
-    If prev_harmony is empty then assign the bass to the root of the chord and randomly
-    assign the alto and tenor within their respective ranges.
+    Generates a four part harmony for each of a list of melodies, spread over a
+    pool of processes. Each melody is harmonised with the random number generator
+    seeded from seed and its position in the list, so the harmonies are the same
+    whatever the number of workers. The state of the random module is restored
+    after each melody
     
     INPUTS:
-        prev_harmony: the previous harmony for the given state
-        melody_pitch: melody pitch (aka the soprano pitch) for the given state
-        chord_notes: chord for the given state in the chord progression
+        melodies: list of music21 Score objects containing one part
+        model: A model as generated by gen_model
+        workers: number of processes. If workers <= 1 the melodies are
+                 harmonised in this process
+        seed: seed from which the seed of each melody is derived. If None
+              it is drawn from the random module
+        stats: optional generation_stats (see gen_harmony). The records of each
+               melody are merged into it in the order of the melodies
         
     RETURNS:
-        list of pitches for the four parts [Bass,Tenor,Alto,Soprano]
+        A list holding for each melody a pair (harmony,error). harmony is a
+        music21 Score object with four parts in harmony and error is None, or
+        harmony is None and error says why that melody could not be harmonised.
+        A melody that fails does not affect the others
     '''
-    try:
-        num_pitches = len(chord_notes)
-        chord_notes_midi = _get_chord_base(chord_notes)
-    
-        assigned_pitches = [None,None,None,None]
-        
-        soprano_pitch = melody_pitch
+    if seed == None:
+        seed = _random.randint(0,MAX_SEED)
         
-        assigned_pitches[SOPRANO] = soprano_pitch
+    harmonies = [None for x in melodies]
+    jobs = []
+    job_indexes = []
+    for (i,melody) in enumerate(melodies):
+        try:
+            melody_notes = _get_melody_notes(melody)
+        except Exception as e:
+            harmonies[i] = (None,'Unable to read melody: ' + str(e))
+            continue
+            
+        if stats != None:
+            jobs.append((None,melody_notes,_derive_seed(seed,i),generation_stats()))
+        else:
+            jobs.append((None,melody_notes,_derive_seed(seed,i),None))
+        job_indexes.append(i)
+            
+    if workers <= 1:
+        _init_harmony_worker(model)
+        results = [_harmonise_job(x) for x in jobs]
+    else:
+        pool = multiprocessing.Pool(workers,_init_harmony_worker,(model,))
+        try:
+            results = pool.map(_harmonise_job,jobs)
+        finally:
+            pool.close()
+            pool.join()
+            
+    for (i,(harmony,error,item_stats)) in zip(job_indexes,results):
+        if stats != None:
+            stats.merge(item_stats)
+            
+        if harmony == None:
+            harmonies[i] = (None,error)
+            continue
+            
+        start_time = time.time()
+        try:
+            harmonies[i] = (_harmony_to_score(melodies[i],harmony),None)
+        except Exception as e:
+            harmonies[i] = (None,'Unable to build score: ' + str(e))
+        if stats != None:
+            stats.add_time('stream_building',start_time)
+            
+    return harmonies
     
-        pitch_options = [x for x in range(LOWEST_PITCH,soprano_pitch.midi) if x%12 in chord_notes_midi]
+def melody_to_events(pitches,durations,voice=SOPRANO):
+    '''
+    Returns the notes of a melody as events
     
-        if num_pitches == 4:
-            for element in [x for x in pitch_options if x%12 == soprano_pitch.midi%12]:
-                pitch_options.remove(element)
+    INPUTS:
+        pitches: midi numbers of the notes, REST_MIDI for a rest
+        durations: durations of the notes in ticks
+        voice: the voice singing the melody (BASS, ALTO, TENOR or SOPRANO)
         
-        if not prev_harmony:
-            root = chord.Chord(chord_notes).findRoot()
-            bass_pitch_midi = min([x for x in RANGES[BASS] if x%12 == root.midi%12])
-            assigned_pitches[BASS] = pitch.Pitch(bass_pitch_midi)
-            pitch_options.remove(bass_pitch_midi)
+    RETURNS:
+        list of (voice,pitch,start,length) for each note, where pitch is a midi
+        number and start and length are in ticks. Rests have no event
+    '''
+    events = []
+    start = 0
     
-        else:
-            valid_alto_pitch_options = _get_valid_pitch_options(prev_harmony,ALTO,assigned_pitches,pitch_options)
-            alto_pitch_midi = _get_nearest_pitch(prev_harmony[ALTO],valid_alto_pitch_options)
-            assigned_pitches[ALTO] = pitch.Pitch(alto_pitch_midi)
-            pitch_options.remove(alto_pitch_midi)
-        
-        if not prev_harmony:
-            if (num_pitches == 4) or (assigned_pitches[BASS].name == assigned_pitches[SOPRANO].name):
-                for element in [x for x in pitch_options if x%12 == bass_pitch_midi%12]:
-                    pitch_options.remove(element)
-    
-            for element in pitch_options:
-                if element <= bass_pitch_midi:
-                    pitch_options.remove(element)
-                    
-        elif (num_pitches == 4) or (assigned_pitches[ALTO].name == assigned_pitches[SOPRANO].name):
-            for element in [x for x in pitch_options if x%12 == alto_pitch_midi%12]:
-                pitch_options.remove(element)
-    
-            for element in pitch_options:
-                if element > alto_pitch_midi:
-                    pitch_options.remove(element)
-        
-        if not prev_harmony:
-            alto_pitch_midi = choice([x for x in pitch_options if x in RANGES[ALTO]])
-            assigned_pitches[ALTO] = pitch.Pitch(alto_pitch_midi)
-            pitch_options.remove(alto_pitch_midi)
-        else:
-            valid_tenor_pitch_options = _get_valid_pitch_options(prev_harmony,TENOR,assigned_pitches,pitch_options)
-            tenor_pitch_midi = _get_nearest_pitch(prev_harmony[TENOR],valid_tenor_pitch_options)
-            assigned_pitches[TENOR] = pitch.Pitch(tenor_pitch_midi)
-            pitch_options.remove(tenor_pitch_midi)
-    
-        if not prev_harmony:
-            if (num_pitches == 4) or (assigned_pitches[BASS].name == assigned_pitches[SOPRANO].name):
-                for element in [x for x in pitch_options if x%12 == alto_pitch_midi%12]:
-                    pitch_options.remove(element)
-        elif (num_pitches == 4) or (assigned_pitches[ALTO].name == assigned_pitches[SOPRANO].name):
-            for element in [x for x in pitch_options if x%12 == tenor_pitch_midi%12]:
-                pitch_options.remove(element)
-            
-        if not prev_harmony:
-            if ((assigned_pitches[ALTO].name == assigned_pitches[SOPRANO].name) or
-                (assigned_pitches[ALTO].name == assigned_pitches[BASS].name)):
-                for element in [x for x in pitch_options if x%12 == soprano_pitch.midi%12]:
-                    pitch_options.remove(element)
-                for element in [x for x in pitch_options if x%12 == bass_pitch_midi%12]:
-                    pitch_options.remove(element)
-        else:
-            if ((assigned_pitches[TENOR].name == assigned_pitches[SOPRANO].name) or
-                (assigned_pitches[TENOR].name == assigned_pitches[ALTO].name)):
-                for element in [x for x in pitch_options if x%12 == soprano_pitch.midi%12]:
-                    pitch_options.remove(element)
-                for element in [x for x in pitch_options if x%12 == alto_pitch_midi%12]:
-                    pitch_options.remove(element)
-    
-        if not prev_harmony:
-            for element in pitch_options:
-                if element > alto_pitch_midi:
-                    pitch_options.remove(element)
+    for (melody_pitch,melody_duration) in zip(pitches,durations):
+        if melody_pitch != REST_MIDI:
+            events.append((voice,melody_pitch,start,melody_duration))
+        start += melody_duration
+        
+    return events
+
+def harmony_to_events(harmony,smooth=False):
+    '''
+    Returns the notes of a four part harmony as events
     
-        else:
-            for element in pitch_options:
-                if element > tenor_pitch_midi:
-                    pitch_options.remove(element)
+    INPUTS:
+        harmony: iterable of (voicing,duration) as yielded by iter_harmony
+        smooth: if True consecutive notes of the bass, alto and tenor with the
+                same pitch and duration are combined as in gen_harmony
         
-        if not prev_harmony:
-            tenor_pitch_midi = choice([x for x in pitch_options if x in RANGES[TENOR]])
-            assigned_pitches[TENOR] = pitch.Pitch(tenor_pitch_midi)
-        else:
-            valid_bass_pitch_options = _get_valid_pitch_options(prev_harmony,BASS,assigned_pitches,pitch_options)
-            bass_pitch_midi = _get_nearest_pitch(prev_harmony[BASS],valid_bass_pitch_options)
-            assigned_pitches[BASS] = pitch.Pitch(bass_pitch_midi)
-    except:
-        return None
+    RETURNS:
+        list of events as returned by melody_to_events, ordered by start
+    '''
+    voice_pitches = [array('h'),array('h'),array('h'),array('h')]
+    voice_durations = [array('i'),array('i'),array('i'),array('i')]
     
-    return assigned_pitches
+    for (voicing,harmony_duration) in harmony:
+        for voice in range(4):
+            voice_pitches[voice].append(voicing[voice])
+            voice_durations[voice].append(harmony_duration)
             
-def _get_valid_pitch_options(prev_harmony,pending_part,assigned_pitches,pitch_options):
+    if smooth:
+        (smooth_pitches,smooth_durations) = _smooth_harmony(voice_pitches[:SOPRANO],voice_durations[:SOPRANO])
+        voice_pitches[:SOPRANO] = smooth_pitches
+        voice_durations[:SOPRANO] = smooth_durations
+        
+    events = []
+    for voice in range(4):
+        events.extend(melody_to_events(voice_pitches[voice],voice_durations[voice],voice))
+    events.sort(key=lambda x: (x[2],x[0]))
+        
+    return events
+
+def events_to_score(events):
     '''
-    Returns a list of valid pitches (as midi numbers) for a given part, given the preceeding
-    harmony, what pitches have already been assigned and what pitch_options remain
+    Returns a music21 Score of a list of events with one part for each voice,
+    ordered from the soprano down. Gaps between the notes of a voice are rests
     '''
-    valid_pitch_options = [x for x in pitch_options if x in RANGES[pending_part]]
+    score = stream.Score()
     
-    for (part,part_pitch) in enumerate(assigned_pitches):
-    
-        if part_pitch != None:
-            prev_interval = interval.notesToInterval(prev_harmony[pending_part],prev_harmony[part])
+    for voice in SCORE_ORDER:
+        voice_events = sorted([x for x in events if x[0] == voice],key=lambda x: x[2])
+        if not voice_events:
+            continue
+            
+        part = stream.Part()
+        if voice in TREBLE_VOICES:
+            part.insert(0,clef.TrebleClef())
+        else:
+            part.insert(0,clef.BassClef())
             
-            if prev_interval.name[0] == 'P':
-                pitch_shift = part_pitch.midi - prev_harmony[part].midi
-                invalid_pitch = pitch.Pitch(prev_harmony[pending_part].midi + pitch_shift)
+        end = 0
+        for (voice,midi,start,length) in voice_events:
+            if start > end:
+                r = note.Rest()
+                r.duration = duration.Duration(float(start-end)/TICKS_PER_QUARTER)
+                part.append(r)
                 
-                if invalid_pitch in valid_pitch_options:
-                    valid_pitch_options.remove(invalid_pitch)
+            n = note.Note(pitch.Pitch(_midi_to_pitch_name(midi)))
+            n.duration = duration.Duration(float(length)/TICKS_PER_QUARTER)
+            part.append(n)
+            end = start + length
             
-    return valid_pitch_options
-           
-def _get_nearest_pitch(pitch,pitch_options):
-    (dist,index) = min([(abs(pitch.midi - element),i) for (i,element) in enumerate(pitch_options)])
-    return pitch_options[index]
+        score.insert(0,part)
+        
+    return score
 
-def _get_chord_base(note_list):
-    parsed_chord = chord.Chord(note_list)
-    return [element.midi%12 for element in parsed_chord.pitches]
-    
-def _get_next_element(model_state):
-    rand_val = random()
-    weight = 0.0
-    total = 0
-    
-    for key in model_state.keys():
-        total += model_state[key]
+def events_to_midi(events,tempo=MIDI_TEMPO):
+    '''
+    Returns the bytes of a Standard MIDI File (format 1) playing a list of
+    events, with one track for each voice and TICKS_PER_QUARTER ticks to
+    the quarter note. Raises ValueError if a pitch is not a midi number from
+    0 to 127 or a start or length is negative
+    '''
+    tempo_track = _midi_var_len(0) + b'\xff\x51\x03' + struct.pack('>I',60000000//tempo)[1:]
+    tracks = [tempo_track + _midi_var_len(0) + b'\xff\x2f\x00']
     
-    for key in model_state.keys():
-        if rand_val >= weight:
-            rv = key
-        weight += float(model_state[key])/float(total)
+    for voice in SCORE_ORDER:
+        voice_events = [x for x in events if x[0] == voice]
+        if not voice_events:
+            continue
+            
+        channel = len(tracks) - 1
+        messages = []
+        for (voice,midi,start,length) in voice_events:
+            if (midi < 0) or (midi > 127):
+                raise ValueError('MIDI pitch out of range: ' + str(midi))
+            if (start < 0) or (length < 0):
+                raise ValueError('Negative start or length of a MIDI event: ' + str((start,length)))
+                
+            messages.append((start,1,struct.pack('BBB',0x90 | channel,midi,MIDI_VELOCITY)))
+            messages.append((start+length,0,struct.pack('BBB',0x80 | channel,midi,0)))
+        messages.sort(key=lambda x: x[:2])
+        
+        track = [_midi_var_len(0) + b'\xff\x03' + _midi_var_len(len(VOICE_NAMES[voice])) + VOICE_NAMES[voice].encode('ascii')]
+        tick = 0
+        for (message_tick,order,message) in messages:
+            track.append(_midi_var_len(message_tick-tick) + message)
+            tick = message_tick
+        track.append(_midi_var_len(0) + b'\xff\x2f\x00')
+        tracks.append(b''.join(track))
+        
+    midi_file = [b'MThd' + struct.pack('>IHHH',6,1,len(tracks),TICKS_PER_QUARTER)]
+    for track in tracks:
+        midi_file.append(b'MTrk' + struct.pack('>I',len(track)) + track)
+        
+    return b''.join(midi_file)
+
+def write_midi(events,filename,tempo=MIDI_TEMPO):
+    '''
+    Writes a list of events to a Standard MIDI File (see events_to_midi).
+    Returns False and prints an error if the file cannot be written
+    '''
+    try:
+        output = open(filename,'wb')
+        output.write(events_to_midi(events,tempo))
+        output.close()
+    except IOError:
+        print 'Error writing to ' + str(filename)
+        return False
+        
+    return True
+
+def write_musicxml(events,filename,beats_per_measure=BEATS_PER_MEASURE):
+    '''
+    Writes a list of events to a MusicXML file with one part for each voice,
+    ordered from the soprano down. The file is written one note at a time
+    without building a score. Notes crossing a barline are split and tied, and
+    gaps between the notes of a voice are rests.
+    
+    Returns False and prints an error if the file cannot be written
+    '''
+    measure_ticks = beats_per_measure*TICKS_PER_QUARTER
+    voices = [x for x in SCORE_ORDER if [y for y in events if y[0] == x]]
+    end = max([0] + [start+length for (voice,midi,start,length) in events])
+    num_measures = max(1,-(-end//measure_ticks))
+    
+    try:
+        output = open(filename,'w')
+        output.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        output.write('<!DOCTYPE score-partwise PUBLIC "-//Recordare//DTD MusicXML 3.0 Partwise//EN" '
+                     '"http://www.musicxml.org/dtds/partwise.dtd">\n')
+        output.write('<score-partwise version="3.0">\n  <part-list>\n')
+        for voice in voices:
+            output.write('    <score-part id="P%d"><part-name>%s</part-name></score-part>\n' % (voice,VOICE_NAMES[voice]))
+        output.write('  </part-list>\n')
+        
+        for voice in voices:
+            voice_events = sorted([x for x in events if x[0] == voice],key=lambda x: x[2])
+            output.write('  <part id="P%d">\n' % voice)
+            
+            position = 0
+            for (voice,midi,start,length) in voice_events + [(voice,REST_MIDI,num_measures*measure_ticks,0)]:
+                if start > position:
+                    _write_musicxml_note(output,REST_MIDI,position,start-position,measure_ticks,voice)
+                if length > 0:
+                    _write_musicxml_note(output,midi,start,length,measure_ticks,voice)
+                position = max(position,start+length)
+                
+            output.write('    </measure>\n  </part>\n')
+            
+        output.write('</score-partwise>\n')
+        output.close()
+    except IOError:
+        print 'Error writing to ' + str(filename)
+        return False
+        
+    return True
+
+def write_pieces(pieces,directory,file_format='midi'):
+    '''
+    Writes many pieces to a directory in one batch
+    
+    INPUTS:
+        pieces: iterable of lists of events, one list for each piece
+        directory: directory the files are written to, created if needed
+        file_format: 'midi' or 'musicxml'
+        
+    RETURNS:
+        list of the names of the files written, piece_00000.mid etc.
+        
+        If a file cannot be written write_pieces prints an
+        error and returns None
+    '''
+    if file_format == 'midi':
+        (write_piece,extension) = (write_midi,'.mid')
+    elif file_format == 'musicxml':
+        (write_piece,extension) = (write_musicxml,'.xml')
+    else:
+        print 'Unknown file format: ' + str(file_format)
+        return None
+        
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+        
+    filenames = []
+    for (i,events) in enumerate(pieces):
+        filename = os.path.join(directory,'piece_%05d%s' % (i,extension))
+        if not write_piece(events,filename):
+            return None
+        filenames.append(filename)
+        
+    return filenames
+
+def score_sequences(model,sequences,component='melody_pitch',floor=None,score_end=False):
+    '''
+    Returns the log probability of each of many sequences under one of the markov
+    models of a model. The sequences are interned with the vocabulary of the model
+    and each transition is looked up by a binary search in the arrays of the compact
+    model. The log probability of each transition is kept once found, so the
+    transitions shared by many sequences are looked up once
+    
+    INPUTS:
+        model: A model as generated by gen_model
+        sequences: iterable of sequences of elements of the markov model: pitch
+                   names or midi numbers for 'melody_pitch', offsets for
+                   'melody_offset' and chords eg. ('A','C','E') for 'chord'
+        component: 'melody_pitch', 'melody_offset' or 'chord'
+        floor: probability given to a transition that is not in the model. If
+               None such a transition makes the log probability -inf
+        score_end: if True the end of each sequence is scored as the end of a
+                   chorale, otherwise the sequence may stop anywhere
+                   
+    RETURNS:
+        An array of the natural log probabilities of the sequences
+        
+        If component is unknown or floor is not a probability
+        score_sequences returns None and prints an error
+    '''
+    if component not in ['melody_pitch','melody_offset','chord']:
+        print 'Unknown component: ' + str(component)
+        return None
+        
+    if floor == None:
+        floor_log_prob = None
+    elif (floor > 0) and (floor <= 1):
+        floor_log_prob = math.log(floor)
+    else:
+        print 'The floor must be a probability greater than 0'
+        return None
+        
+    samplers = model.get_samplers()
+    if 'scorers' not in samplers:
+        samplers['scorers'] = {}
+        
+    if component not in samplers['scorers']:
+        if component == 'chord':
+            compact_model = samplers['chord'].chord_model
+        else:
+            compact_model = samplers[component].model
+        samplers['scorers'][component] = _sequence_scorer(compact_model,samplers['vocabulary'])
+        
+    scorer = samplers['scorers'][component]
+    scores = array('d')
+    
+    for sequence in sequences:
+        if component == 'melody_pitch':
+            sequence = [_midi_to_element(x) for x in sequence]
+        scores.append(scorer.score(sequence,floor_log_prob,score_end))
+        
+    return scores
+
+def top_k(candidates,k):
+    '''
+    Keeps the k best of a stream of scored candidates. At most k candidates are
+    held at once, in a heap, so candidates can be generated, scored and ranked
+    in batches of any size
+    
+    INPUTS:
+        candidates: iterable of (score,candidate)
+        k: number of candidates to keep
+        
+    RETURNS:
+        list of the k (score,candidate) with the highest scores, best first.
+        Of candidates with equal scores the earliest is kept and listed first
+    '''
+    heap = []
+    if k <= 0:
+        return heap
+        
+    for (i,(score,candidate)) in enumerate(candidates):
+        if len(heap) < k:
+            heapq.heappush(heap,(score,-i,candidate))
+        elif score > heap[0][0]:
+            heapq.heapreplace(heap,(score,-i,candidate))
+            
+    return [(score,candidate) for (score,i,candidate) in sorted(heap,reverse=True)]
+    
+'''
+PRIVATE FUNCTIONS
+'''
+def _gen_melody_component(element_sampler,model_order,melody_len,constraint):
+    '''
+    Generates a component of the melody i.e. the melody pitches
+    or the melody offsets
+    
+    INPUTS:
+        element_sampler: compiled markov model for the given element
+        model_order: order of element markov model
+        melody_len: desired length of melody
+        constraint: frozenset of the ids of the possible options for an element in
+                    the melody. Each element is drawn from the distribution of the
+                    allowed elements of the current state. If constraint == None
+                    there is no restriction on what elements can be in the melody
+        
+    Only elements from which the rest of the melody can still be generated are
+    drawn (see _markov_sampler.draw), so the markov chain does not reach the end
+    of a chorale or a state with no allowed elements part way through the melody.
+        
+    RETURNS:
+        A list of elements as generated by the element markov model
+        
+        If no melody of melody_len elements can be generated from the model
+        _gen_melody_component returns None. This can only happen part way
+        through a melody longer than REACH_HORIZON
+    '''
+    melody_elements = []
+    count = 0
+    
+    # One more element than the melody must follow it
+    element_buff = tuple([NULL_ID for x in range(model_order)])
+    next_element = element_sampler.draw(element_buff,constraint,melody_len+1)
+    
+    while (count < melody_len):
+        if (next_element == None) or (next_element == NULL_ID):
+            return None
+            
+        melody_elements.append(next_element)
+        count += 1
+
+        element_buff = element_buff[1:] + (next_element,)
+        next_element = element_sampler.draw(element_buff,constraint,melody_len+1-count)
+
+    if (next_element == None) or (next_element == NULL_ID):
+        return None
+            
+    return [element_sampler.vocabulary.elements[x] for x in melody_elements]
+
+def _gen_melody_components(element_sampler,model_order,n,melody_len,constraint,max_attempts=1000):
+    '''
+    Generates n melody components (see _gen_melody_component) by advancing
+    n markov chains in lock step. Elements are drawn as in _gen_melody_component,
+    and a chain that reaches the end of a chorale or a state with no allowed
+    elements is restarted.
+    
+    RETURNS:
+        An array of the element ids of the n components one after the other,
+        or None if some component could not be generated in max_attempts
+    '''
+    elements = array('i',[NULL_ID])*(n*melody_len)
+    start_buff = tuple([NULL_ID for x in range(model_order)])
+    pending = range(n)
+    attempts = 0
+    
+    while pending:
+        if attempts >= max_attempts:
+            return None
+        attempts += 1
+        
+        chains = [(i,start_buff) for i in pending]
+        failed = []
+        
+        for position in range(melody_len+1):
+            next_chains = []
+            
+            for (i,element_buff) in chains:
+                next_element = element_sampler.draw(element_buff,constraint,melody_len+1-position)
+                
+                if (next_element == None) or (next_element == NULL_ID):
+                    failed.append(i)
+                    continue
+                    
+                if position < melody_len:
+                    elements[i*melody_len + position] = next_element
+                next_chains.append((i,element_buff[1:] + (next_element,)))
+                
+            chains = next_chains
+            
+        pending = failed
+        
+    return elements
+
+def _build_model(model,bwv_nums,workers,feature_cache,stats=None):
+    '''
+    Adds the chorales in bwv_nums to an empty model. If workers > 1 the chorales
+    are split into contiguous chunks which are parsed by a pool of processes.
+    The partial models are merged in chunk order as they arrive, so that states
+    and transitions are added in the same order as they would be by a single
+    process and only one partial model is held at a time.
+    
+    Each process records its chorales in a generation_stats of its own, which
+    are merged into stats in chunk order
+    '''
+    if workers <= 1:
+        return _build_partial_model((model,bwv_nums,feature_cache,stats))[0]
+    
+    chunk_size = max(1,-(-len(bwv_nums) // (workers*4)))
+    chunks = []
+    for i in range(0,len(bwv_nums),chunk_size):
+        if stats != None:
+            chunks.append((model,bwv_nums[i:i+chunk_size],feature_cache,generation_stats()))
+        else:
+            chunks.append((model,bwv_nums[i:i+chunk_size],feature_cache,None))
+    
+    pool = multiprocessing.Pool(workers)
+    try:
+        for (partial_model,partial_stats) in pool.imap(_build_partial_model,chunks):
+            model.merge_model(partial_model)
+            if stats != None:
+                stats.merge(partial_stats)
+    finally:
+        pool.close()
+        pool.join()
+        
+    return model
+
+def _build_partial_model(args):
+    '''
+    Adds the chorales in a list of BWV numbers to an empty model. Takes a single
+    tuple (model,bwv_nums,feature_cache,stats) so that it can be passed to
+    multiprocessing.Pool.map, and returns (model,stats)
+    '''
+    (model,bwv_nums,feature_cache,stats) = args
+    
+    for bwv_num in bwv_nums:
+        start_time = time.time()
+        model.add_features_to_model(_get_chorale_features(bwv_num,feature_cache,stats == None))
+        
+        if stats != None:
+            stats.add_chorale(bwv_num,time.time() - start_time)
+        
+    return (model,stats)
+
+def _get_chorale_features(bwv_num,feature_cache,verbose=True):
+    '''
+    Returns the sequences extracted from a chorale as a dictionary with the keys
+    'melody_pitches', 'melody_offsets' and 'chords'. A sequence is None if it
+    could not be extracted from the chorale.
+    
+    If feature_cache is a directory the sequences are read from it when present
+    and written to it after the chorale has been parsed. If verbose is True the
+    chorale is printed when it is parsed
+    '''
+    if feature_cache:
+        filename = os.path.join(feature_cache,'bwv' + str(bwv_num) + '_' + str(EXTRACTOR_VERSION))
+        
+        if os.path.exists(filename + '.pkl'):
+            features = _file_to_dict(filename + '.pkl')
+            if features:
+                return features
+    
+    stream = corpus.parse('bach/bwv' + str(bwv_num))
+    if verbose:
+        print 'Now parsing: ' + 'bach/bwv' + str(bwv_num)
+    
+    features = _extract_features(stream)
+    features['bwv'] = bwv_num
+    features['extractor_version'] = EXTRACTOR_VERSION
+    
+    if feature_cache:
+        if not os.path.isdir(feature_cache):
+            try:
+                os.makedirs(feature_cache)
+            except OSError:
+                pass
+        _dict_to_file_atomic(features,filename)
+        
+    return features
+
+def _add_scores(model,source):
+    '''
+    Adds the scores of a source to a model for add_score (see chorale_model.add_score)
+    and returns the number of scores added
+    '''
+    if not isinstance(source,basestring):
+        features = _extract_features(source,True)
+        entry = 'score ' + hashlib.sha1(repr(sorted(features.items())).encode('utf-8')).hexdigest()
+        return _add_score_features(model,features,entry,'stream')
+        
+    if os.path.isdir(source):
+        filenames = [os.path.join(source,x) for x in sorted(os.listdir(source))
+                     if os.path.splitext(x)[1].lower() in SCORE_EXTENSIONS]
+    else:
+        filenames = [source]
+        
+    count = 0
+    for filename in filenames:
+        try:
+            score_file = open(filename,'rb')
+            entry = 'score ' + hashlib.sha1(score_file.read()).hexdigest()
+            score_file.close()
+        except IOError:
+            print 'Error reading from ' + filename
+            continue
+            
+        if entry in model.manifest:
+            print 'Already in model: ' + filename
+            continue
+            
+        try:
+            s = converter.parse(filename)
+        except Exception:
+            print 'Unable to parse ' + filename
+            continue
+            
+        count += _add_score_features(model,_extract_features(s,True),entry,filename)
+        
+    return count
+
+def _add_score_features(model,features,entry,name):
+    if entry in model.manifest:
+        print 'Already in model: ' + name
+        return 0
+        
+    if features['melody_pitches'] == None:
+        print 'Unable to find a soprano part in ' + name
+        return 0
+        
+    print 'Now adding: ' + name
+    model.add_features_to_model(features)
+    model.manifest.append(entry)
+    
+    return 1
+
+def _extract_features(s,positional=False):
+    '''
+    Extracts the melody pitches, melody offsets and chords of a chorale in one
+    pass. The key of the four parts is analysed once and each part is flattened
+    once. Rather than transposing and chordifying copies of the parts, each
+    pitch is transposed to C by the interval music21's transpose would use, so
+    it keeps its spelling, and the chords are read from the parts by
+    _get_chord_segments.
+    
+    The parts are found by their ids 'Soprano', 'Alto', 'Tenor' and 'Bass'. If
+    positional is True and none of the ids is found, a score of exactly four
+    parts is taken to be the soprano, alto, tenor and bass from the top down.
+    
+    RETURNS:
+        A dictionary with the keys 'melody_pitches', 'melody_offsets' and 'chords'
+        where the melody pitches are strings eg. 'C4' or 'REST', the offsets are
+        those of the soprano notes and rests, and a chord is a tuple of note names
+        eg. ('A','C','E'). Only chords lasting at least a quarter note and
+        containing at least three notes are included. A sequence is None if the
+        parts it needs are missing
+    '''
+    features = {'melody_pitches':None,'melody_offsets':None,'chords':None}
+    
+    parts = [s.getElementById(part_id) for part_id in VOICE_NAMES]
+    if positional and (parts.count(None) == 4) and (len(s.parts) == 4):
+        parts = list(reversed(list(s.parts)))
+        
+    if parts[SOPRANO] == None:
+        return features
+        
+    soprano_stream = parts[SOPRANO].flat.notesAndRests
+    
+    if None in parts:
+        num_half_steps = _get_half_steps_from_c(soprano_stream)
+    else:
+        satb_stream = stream.Score()
+        for part in reversed(parts):
+            satb_stream.insert(0,part)
+        num_half_steps = _get_half_steps_from_c(satb_stream)
+        
+    transposition = interval.Interval(-1*num_half_steps)
+    transposed_pitches = {}
+    
+    melody_pitches = []
+    for element in soprano_stream:
+        if element.isRest:
+            melody_pitches.append('REST')
+        elif element.isNote:
+            melody_pitches.append(str(_transpose_pitch(element.pitch,transposition,transposed_pitches)))
+            
+    features['melody_pitches'] = melody_pitches
+    features['melody_offsets'] = [element.offset for element in soprano_stream]
+    
+    if None in parts:
+        return features
+        
+    chords = []
+    for (chord_duration,segment_pitches) in _get_chord_segments(parts):
+        if chord_duration >= 1.0:
+            chord_pitches = tuple(sorted(set([_transpose_pitch(x,transposition,transposed_pitches).name for x in segment_pitches])))
+            if len(chord_pitches) >= 3:
+                chords.append(chord_pitches)
+                
+    features['chords'] = chords
+    
+    return features
+
+def _transpose_pitch(p,transposition,transposed_pitches):
+    '''
+    Returns a pitch transposed by an interval. The transposed pitches are kept
+    in transposed_pitches by name, so each distinct pitch of a chorale is
+    transposed once
+    '''
+    name = p.nameWithOctave
+    if name not in transposed_pitches:
+        transposed_pitches[name] = p.transpose(transposition)
+        
+    return transposed_pitches[name]
+
+def _get_chord_segments(parts):
+    '''
+    Returns the pitches sounding in each segment of a list of parts as
+    (quarter length,pitches), where the segments are divided at every note
+    onset, note end and barline of the parts. These are the chords music21's
+    chordify makes: a grace note sounds in the segment starting at its offset
+    '''
+    boundaries = set()
+    notes = []
+    grace_notes = {}
+    
+    for part in parts:
+        for measure in part.getElementsByClass('Measure'):
+            boundaries.add(measure.offset)
+            boundaries.add(measure.offset + measure.duration.quarterLength)
+            
+        for element in part.flat.notes:
+            note_start = element.offset
+            note_end = note_start + element.duration.quarterLength
+            
+            if note_end == note_start:
+                grace_notes.setdefault(note_start,[]).extend(element.pitches)
+                continue
+                
+            for p in element.pitches:
+                notes.append((note_start,note_end,p))
+            boundaries.add(note_start)
+            boundaries.add(note_end)
+            
+    boundaries = sorted(boundaries)
+    notes.sort(key=lambda x: x[0])
+    segments = []
+    sounding = []
+    i = 0
+    
+    for (segment_start,segment_end) in zip(boundaries[:-1],boundaries[1:]):
+        while (i < len(notes)) and (notes[i][0] <= segment_start):
+            sounding.append(notes[i])
+            i += 1
+        sounding = [x for x in sounding if x[1] > segment_start]
+        
+        segment_pitches = [x[2] for x in sounding] + grace_notes.get(segment_start,[])
+        if segment_pitches:
+            segments.append((segment_end - segment_start,segment_pitches))
+            
+    return segments
+
+def _extract_melody_pitches(s):
+    '''
+    Returns the soprano pitches of a chorale transposed to C as strings eg. 'C4'.
+    Rests are returned as 'REST'. The pitches are those of _extract_features, so
+    models built one sequence at a time share their vocabulary with models
+    built by add_chorale_to_model
+    '''
+    return _extract_features(s)['melody_pitches']
+
+def _extract_melody_offsets(s):
+    '''
+    Returns the offsets of the soprano notes and rests of a chorale
+    '''
+    return _extract_features(s)['melody_offsets']
+
+def _extract_chords(s):
+    '''
+    Returns the chords of a chorale transposed to C where a chord is a
+    tuple of note names eg. ('A','C','E'), as extracted by _extract_features.
+    Only chords lasting at least a quarter note and containing at least three
+    notes are included
+    '''
+    return _extract_features(s)['chords']
+
+def _iter_melody_component(element_sampler,model_order,constraint,mark_restarts=False):
+    '''
+    Yields the ids of the elements of a melody component (see _gen_melody_component)
+    without end. When the markov chain reaches the end of a chorale or a state
+    with no allowed elements it starts again from the initial state. If
+    mark_restarts is True NULL_ID is yielded each time the chain starts again
+    '''
+    start_buff = tuple([NULL_ID for x in range(model_order)])
+    element_buff = start_buff
+    
+    while True:
+        next_element = element_sampler.draw(element_buff,constraint)
+        
+        if (next_element == None) or (next_element == NULL_ID):
+            if element_buff == start_buff:
+                return
+            element_buff = start_buff
+            if mark_restarts:
+                yield NULL_ID
+            continue
+            
+        yield next_element
+        element_buff = element_buff[1:] + (next_element,)
+
+def _voice_window(window,prev_voicing,chord_table):
+    '''
+    Finds the voicings of the chords in a window of iter_harmony following
+    prev_voicing. If they cannot follow prev_voicing the voicings are found
+    as for the start of a piece
+    '''
+    chords = [chord_notes for (chord_notes,soprano_midi,melody_duration) in window if chord_notes != None]
+    soprano_pitches = [soprano_midi for (chord_notes,soprano_midi,melody_duration) in window if chord_notes != None]
+    
+    voicings = None
+    if prev_voicing != None:
+        voicings = _find_voicings(chords,soprano_pitches,prev_voicing,chord_table)
+    if voicings == None:
+        voicings = _find_voicings(chords,soprano_pitches,None,chord_table)
+        
+    return voicings
+
+def _get_melody_notes(melody):
+    '''
+    Returns the notes and rests of a melody as a list of (midi,quarter_length),
+    where midi is REST_MIDI for a rest
+    '''
+    melody_notes = []
+    
+    for n in melody.flat.notesAndRests:
+        if n.isRest:
+            melody_notes.append((REST_MIDI,n.duration.quarterLength))
+        else:
+            melody_notes.append((n.pitch.midi,n.duration.quarterLength))
+            
+    return melody_notes
+
+def _harmonise(melody_notes,model,stats=None):
+    '''
+    Finds the bass, alto and tenor of a harmony for a melody given as returned by
+    _get_melody_notes. No music21 objects are used.
+    
+    RETURNS:
+        [pitches,durations] of the parts as returned by _smooth_harmony
+        
+        If no harmony fits the chord progression drawn from
+        the model _harmonise returns None and prints an error
+    '''
+    start_time = time.time()
+    samplers = model.get_samplers()
+    
+    chord_prog = _gen_chord_prog(melody_notes,samplers['chord'],model.chord_order,stats)
+    
+    if stats != None:
+        start_time = stats.add_time('chord_progression',start_time)
+        
+    if chord_prog == None:
+        if stats != None:
+            stats.add_count('chord_progression_failures')
+        print 'Unable to realize harmony with given melody'
+        return None
+        
+    [chord_prog_pitches,harmony_durations] = chord_prog
+
+    harmony_pitches = _voice_chord_prog(melody_notes,chord_prog_pitches,samplers['chord_table'])
+    
+    if stats != None:
+        start_time = stats.add_time('voicing',start_time)
+        
+    if harmony_pitches == None:
+        if stats != None:
+            stats.add_count('voicing_failures')
+        print 'Unable to realize harmony with given melody'
+        return None
+
+    voice_pitches = [array('h'),array('h'),array('h')]
+    voice_durations = [array('i'),array('i'),array('i')]
+    
+    for (voicing,chord_duration) in zip(harmony_pitches,harmony_durations):
+        for (midi,pitches,durations) in zip(voicing,voice_pitches,voice_durations):
+            pitches.append(midi)
+            durations.append(int(round(chord_duration*TICKS_PER_QUARTER)))
+            
+    harmony = _smooth_harmony(voice_pitches,voice_durations)
+    
+    if stats != None:
+        stats.add_time('smoothing',start_time)
+        
+    return harmony
+
+def _harmony_to_score(melody,harmony):
+    '''
+    Returns a Score of a melody and the parts of a harmony found by _harmonise.
+    A treble clef is inserted into the melody, which becomes the top part, and
+    the alto, tenor and bass follow it with their own clefs
+    '''
+    (voice_pitches,voice_durations) = harmony
+    
+    melody.insert(0,clef.TrebleClef())
+    harmony_score = stream.Score()
+    harmony_score.insert(0,melody)
+    
+    for voice in SCORE_ORDER[1:]:
+        part = stream.Part()
+        if voice in TREBLE_VOICES:
+            part.insert(0,clef.TrebleClef())
+        else:
+            part.insert(0,clef.BassClef())
+        
+        for (midi,ticks) in zip(voice_pitches[voice],voice_durations[voice]):
+            if midi == REST_MIDI:
+                n = note.Rest()
+            else:
+                n = note.Note(pitch.Pitch(midi))
+                
+            n.duration = duration.Duration(float(ticks)/TICKS_PER_QUARTER)
+            part.append(n)
+            
+        harmony_score.insert(0,part)
+        
+    return harmony_score
+
+def _init_harmony_worker(model):
+    '''
+    Keeps the model in a process of gen_harmonies and compiles its samplers once
+    '''
+    _harmony_worker['model'] = model
+    model.get_samplers()
+
+def _harmonise_job(args):
+    '''
+    Harmonises one melody of gen_harmonies. Takes a single tuple
+    (model,melody_notes,seed,stats), where model == None stands for the model of
+    the process, so that it can be passed to multiprocessing.Pool.map. Returns
+    (harmony,error,stats) where harmony is None and error a message if the
+    melody could not be harmonised
+    '''
+    (model,melody_notes,seed,stats) = args
+    if model == None:
+        model = _harmony_worker['model']
+        
+    random_state = _random.getstate()
+    _random.seed(seed)
+    
+    try:
+        harmony = _harmonise(melody_notes,model,stats)
+        if harmony == None:
+            return (None,'Unable to realize harmony with given melody',stats)
+        return (harmony,None,stats)
+    except Exception as e:
+        print 'Unable to harmonise melody: ' + str(e)
+        return (None,'Unable to harmonise melody: ' + str(e),stats)
+    finally:
+        _random.setstate(random_state)
+
+def _derive_seed(seed,index):
+    '''
+    Returns the seed of item index of a batch generated from seed. The seeds are
+    the same on every platform and version of Python
+    '''
+    return int(hashlib.sha1((str(seed) + ' ' + str(index)).encode('ascii')).hexdigest()[:8],16)
+
+def _get_melody_durations(melody_offsets):
+    '''
+    Returns a list of note durations (quarter note, half note, etc.) 
+    given a list of note offsets
+    '''
+    melody_durations = []
+    
+    for i in range(len(melody_offsets)-1):
+        offset_delta = melody_offsets[i+1] - melody_offsets[i]
+
+        if offset_delta < 0.0:
+            offset_delta = (4 - melody_offsets[i]) + melody_offsets[i+1]
+
+        melody_durations.append(offset_delta)
+        
+    return melody_durations
+    
+def _gen_chord_prog(melody_notes,chord_index,chord_model_order,stats=None):
+    '''
+    Returns a list of chords that form a chord progression to match the melody
+    
+    INPUTS:
+        melody_notes: notes and rests of the melody as returned by _get_melody_notes
+        chord_index: _chord_index of the chord markov model. For each melody note
+                     it gives the chords containing the note that can follow the
+                     current state, falling back on all chords used in the chord
+                     markov model when the markov model is unable to produce a
+                     chord for the note
+        chord_model_order: order of chord markov model
+        stats: optional generation_stats counting the chords drawn from the chord weights
+    
+    RETURNS:
+        list of chords where a chord is a tuple of notes eg. ('A','C','E')
+        
+        If no chord in the model contains a note of the melody
+        _gen_chord_prog returns None
+    '''
+    chord_prog = []
+    chord_durations = []
+
+    chord_buff = tuple([NULL_ID for x in range(chord_model_order)])
+    
+    for (midi,quarter_length) in melody_notes:
+        if midi != REST_MIDI:
+            if (stats != None) and (chord_index.get_state(chord_buff,midi%12) == None):
+                stats.add_count('chord_fallbacks')
+                
+            next_chord = chord_index.draw(chord_buff,midi%12)
+            if next_chord == None:
+                return None
+            if next_chord != NULL_ID:
+                chord_prog.append(chord_index.vocabulary.elements[next_chord])
+                chord_durations.append(quarter_length)
+                
+            chord_buff = chord_buff[1:] + (next_chord,)
+
+        else:
+            chord_prog.append(['REST'])
+            chord_durations.append(quarter_length)
+
+    return [chord_prog,chord_durations]
+    
+def _voice_chord_prog(melody_notes,chord_prog,chord_table=None):
+    '''
+    Assigns pitches to the bass, alto and tenor for every chord of a chord progression.
+    Rests are skipped, so the voice leading carries across them.
+    
+    INPUTS:
+        melody_notes: notes and rests of the melody as returned by _get_melody_notes
+        chord_prog: chords for each note of the melody as generated by _gen_chord_prog
+        chord_table: chord table of the model (see _get_chord_entry)
+        
+    RETURNS:
+        voicing of each chord as returned by _get_chord_voicings, or a voicing
+        of REST_MIDI in every part for a rest
+        
+        If no voicing of the chord progression exists _voice_chord_prog returns None
+    '''
+    voiced_notes = [(melody_note,chord_notes) for (melody_note,chord_notes) in zip(melody_notes,chord_prog)
+                    if not (melody_note[0] == REST_MIDI or chord_notes in ('REST',['REST']))]
+    
+    voicings = _find_voicings([chord_notes for (melody_note,chord_notes) in voiced_notes],
+                              [melody_note[0] for (melody_note,chord_notes) in voiced_notes],
+                              None,chord_table)
+    if voicings == None:
+        return None
+    
+    harmony_pitches = []
+    
+    for (melody_note,chord_notes) in zip(melody_notes,chord_prog):
+        if melody_note[0] == REST_MIDI or chord_notes in ('REST',['REST']):
+            harmony_pitches.append((REST_MIDI,REST_MIDI,REST_MIDI,REST_MIDI))
+        else:
+            harmony_pitches.append(voicings.pop(0))
+            
+    return harmony_pitches
+
+def _find_voicings(chords,soprano_pitches,prev_voicing=None,chord_table=None):
+    '''
+    Finds the voicing of each chord of a list of chords.
+    
+    The legal voicings of each chord are enumerated by _get_chord_voicings and the
+    sequence of voicings with the least total voice movement is found with dynamic
+    programming, so a sequence is found whenever one exists. A voicing may not follow
+    the previous voicing if any two voices a perfect interval apart move in parallel
+    (see _get_perfect_pairs). If prev_voicing is None the first chord has its root in
+    the bass, otherwise the first chord follows prev_voicing.
+    
+    INPUTS:
+        chords: list of chords eg. ('A','C','E')
+        soprano_pitches: the midi number of the soprano of each chord
+        prev_voicing: voicing preceding the first chord, or None
+        chord_table: chord table of the model (see _get_chord_entry). Chords
+                     missing from it are worked out and added to it
+        
+    RETURNS:
+        list of voicings as returned by _get_chord_voicings, or None if there
+        is no sequence of voicings
+    '''
+    layers = []
+    
+    if chord_table == None:
+        chord_table = {}
+    
+    if prev_voicing != None:
+        layers.append(([prev_voicing],[0],[None]))
+    
+    for (chord_notes,soprano_midi) in zip(chords,soprano_pitches):
+        voicings = _get_chord_voicings(chord_notes,soprano_midi,len(layers) == 0,chord_table)
+        if not voicings:
+            return None
+            
+        if not layers:
+            costs = [0 for voicing in voicings]
+            back_pointers = [None for voicing in voicings]
+        else:
+            (prev_voicings,prev_costs,prev_back_pointers) = layers[-1]
+            prev_perfect_pairs = [_get_perfect_pairs(x) for x in prev_voicings]
+            costs = []
+            back_pointers = []
+            
+            for voicing in voicings:
+                best_cost = None
+                best_index = None
+                
+                for (i,x) in enumerate(prev_voicings):
+                    if prev_costs[i] == None:
+                        continue
+                        
+                    cost = _get_voice_leading_cost(x,voicing,prev_perfect_pairs[i])
+                    if cost == None:
+                        continue
+                        
+                    cost += prev_costs[i]
+                    if (best_cost == None) or (cost < best_cost):
+                        best_cost = cost
+                        best_index = i
+                        
+                costs.append(best_cost)
+                back_pointers.append(best_index)
+                
+            if costs.count(None) == len(costs):
+                return None
+                
+        layers.append((voicings,costs,back_pointers))
+        
+    if prev_voicing != None:
+        layers.pop(0)
+        
+    found_voicings = []
+    if layers:
+        (voicings,costs,back_pointers) = layers[-1]
+        index = min([(final_cost,i) for (i,final_cost) in enumerate(costs) if final_cost != None])[1]
+        
+        for (voicings,costs,back_pointers) in reversed(layers):
+            found_voicings.append(voicings[index])
+            index = back_pointers[index]
+            
+        found_voicings.reverse()
+        
+    return found_voicings
+
+def _get_chord_voicings(chord_notes,soprano_midi,first_chord,chord_table):
+    '''
+    Returns every legal voicing of a chord under a soprano pitch as a tuple of
+    midi numbers indexed by BASS, ALTO, TENOR and SOPRANO.
+    
+    Every voice sings a note of the chord within its range in RANGES and below
+    the voice above it. The voices of a four note chord each sing a different
+    note, so the soprano is not doubled. Otherwise at most one note is doubled.
+    If first_chord is True the root of the chord is in the bass.
+    
+    The notes of the chord and of the voicings are kept as pitch class masks
+    (see PITCH_CLASS_BITS), so each voicing is checked with a few integer operations.
+    The facts about the chord are looked up in chord_table
+    '''
+    chord_notes = tuple(chord_notes)
+    
+    if chord_notes not in chord_table:
+        chord_table[chord_notes] = _get_chord_entry(chord_notes)
+        
+    (pitch_classes,chord_mask,root,bass_options) = chord_table[chord_notes]
+    
+    if len(chord_notes) == 4:
+        num_distinct = 4
+    else:
+        num_distinct = 3
+        
+    if first_chord:
+        bass_options = _get_voice_options(BASS,PITCH_CLASS_BITS[root])
+        
+    tenor_options = _get_voice_options(TENOR,chord_mask)
+    alto_options = _get_voice_options(ALTO,chord_mask)
+    
+    voicings = []
+    
+    for bass_midi in bass_options:
+        bass_mask = PITCH_CLASS_BITS[soprano_midi] | PITCH_CLASS_BITS[bass_midi]
+        
+        for tenor_midi in tenor_options:
+            if tenor_midi <= bass_midi:
+                continue
+            tenor_mask = bass_mask | PITCH_CLASS_BITS[tenor_midi]
+            
+            for alto_midi in alto_options:
+                if alto_midi >= soprano_midi:
+                    break
+                if alto_midi <= tenor_midi:
+                    continue
+                if PITCH_CLASS_COUNTS[tenor_mask | PITCH_CLASS_BITS[alto_midi]] < num_distinct:
+                    continue
+                    
+                voicing = [None,None,None,None]
+                voicing[BASS] = bass_midi
+                voicing[ALTO] = alto_midi
+                voicing[TENOR] = tenor_midi
+                voicing[SOPRANO] = soprano_midi
+                voicings.append(tuple(voicing))
+                
+    return voicings
+
+def _get_chord_entry(chord_notes):
+    '''
+    Returns the entry of a chord in a chord table, which maps each chord of a
+    model to (pitch_classes,mask,root,bass_options):
+        pitch_classes: the sorted pitch classes of the chord
+        mask: the mask of the pitch classes (see PITCH_CLASS_BITS)
+        root: the pitch class of the root of the chord (see _find_root)
+        bass_options: the midi numbers in RANGES[BASS] of notes of the chord
+    '''
+    pitch_classes = tuple(sorted(set([_pitch_name_to_midi(name)%12 for name in chord_notes])))
+    
+    chord_mask = 0
+    for pitch_class in pitch_classes:
+        chord_mask |= PITCH_CLASS_BITS[pitch_class]
+        
+    return (pitch_classes,chord_mask,_find_root(chord_notes),tuple(_get_voice_options(BASS,chord_mask)))
+
+def _update_chord_table(chord_table,chords):
+    '''
+    Adds the chords that are not yet in a chord table to it
+    '''
+    for chord_notes in chords:
+        if isinstance(chord_notes,tuple) and (chord_notes not in chord_table):
+            chord_table[chord_notes] = _get_chord_entry(chord_notes)
+
+def _find_root(chord_notes):
+    '''
+    Returns the pitch class of the root of a chord given as pitch names. The root
+    is found from the letter names of the notes as music21's findRoot finds it:
+    the note above which the other notes stack in thirds, or failing that the
+    note with the most thirds, fifths and sevenths, then seconds, fourths and
+    sixths, above it
+    '''
+    names = {}
+    steps = []
+    
+    for name in chord_notes:
+        step = PITCH_STEPS.index(name[0])
+        if step not in names:
+            names[step] = name
+            steps.append(step)
+            
+    if len(steps) == 1:
+        return _pitch_name_to_midi(chord_notes[0])%12
+    if len(steps) == len(PITCH_STEPS):
+        return min([_pitch_name_to_midi(name) for name in chord_notes])%12
+        
+    sorted_steps = sorted(steps)
+    for start in range(len(sorted_steps)):
+        stacked = True
+        for i in range(start,start + len(sorted_steps) - 1):
+            step_size = sorted_steps[(i+1)%len(sorted_steps)] - sorted_steps[i%len(sorted_steps)]
+            if step_size not in (2,-5):
+                stacked = False
+                break
+        if stacked:
+            return _pitch_name_to_midi(names[sorted_steps[start]])%12
+            
+    scores = []
+    for step in steps:
+        score = 0
+        for (i,chord_step) in enumerate([3,5,7,2,4,6]):
+            if (step + chord_step - 1)%7 in names:
+                score += 1.0/(i + 6)
+        scores.append(score)
+        
+    return _pitch_name_to_midi(names[steps[scores.index(max(scores))]])%12
+
+def _get_voice_options(voice,mask):
+    '''
+    Returns the midi numbers in the range of a voice whose pitch classes are
+    in mask, in increasing order. Each list is made once and kept in _voice_options
+    '''
+    if (voice,mask) not in _voice_options:
+        _voice_options[(voice,mask)] = [x for x in RANGES[voice] if PITCH_CLASS_BITS[x] & mask]
+        
+    return _voice_options[(voice,mask)]
+
+def _get_perfect_pairs(voicing):
+    '''
+    Returns the pairs of parts of a voicing that are a perfect interval apart
+    '''
+    return [(part,other_part) for (part,other_part) in VOICE_PAIRS
+            if PERFECT_INTERVALS[abs(voicing[part] - voicing[other_part])]]
+
+def _get_voice_leading_cost(prev_voicing,voicing,prev_perfect_pairs):
+    '''
+    Returns the total distance moved by the bass, alto and tenor between two
+    voicings, or None if two parts a perfect interval apart move in parallel
+    '''
+    for (part,other_part) in prev_perfect_pairs:
+        pitch_shift = voicing[part] - prev_voicing[part]
+        if (pitch_shift != 0) and (pitch_shift == voicing[other_part] - prev_voicing[other_part]):
+            return None
             
+    return (abs(voicing[BASS] - prev_voicing[BASS]) +
+            abs(voicing[ALTO] - prev_voicing[ALTO]) +
+            abs(voicing[TENOR] - prev_voicing[TENOR]))
+
+def _midi_to_pitch_name(midi):
+    '''
+    Returns the name with octave of a midi number, spelled as music21 spells
+    pitch.Pitch(midi) eg. 61 -> 'C#4', 70 -> 'B-4'
+    '''
+    return PITCH_NAMES[midi%12] + str(midi//12 - 1)
+
+def _pitch_name_to_midi(name):
+    '''
+    Returns the midi number of a pitch name with octave eg. 'C#4' or 'B-3'.
+    A name without an octave is taken to be in octave 4
+    '''
+    midi = PITCH_CLASSES[name[0]]
+    i = 1
+    
+    while (i < len(name)) and (name[i] in '#-'):
+        if name[i] == '#':
+            midi += 1
+        else:
+            midi -= 1
+        i += 1
+        
+    if i < len(name):
+        octave = int(name[i:])
+    else:
+        octave = 4
+        
+    return midi + (octave+1)*12
+
+def _midi_to_element(midi):
+    '''
+    Returns the melody pitch element of a midi number: its pitch name, or 'REST'
+    for REST_MIDI. Pitch names are returned unchanged
+    '''
+    if isinstance(midi,basestring):
+        return midi
+    if midi == REST_MIDI:
+        return 'REST'
+        
+    return _midi_to_pitch_name(midi)
+
+def _get_midi_table(vocabulary):
+    '''
+    Returns a list giving the midi number of every pitch in a vocabulary, indexed
+    by id. Rests are REST_MIDI and elements that are not pitches are None
+    '''
+    midi_table = []
+    
+    for element in vocabulary.elements:
+        if element == 'REST':
+            midi_table.append(REST_MIDI)
+        elif isinstance(element,str) and (element[0] in PITCH_CLASSES):
+            midi_table.append(_pitch_name_to_midi(element))
+        else:
+            midi_table.append(None)
+            
+    return midi_table
+
+def _midi_var_len(value):
+    '''
+    Returns a number as a MIDI variable length quantity. Raises ValueError
+    if the number is negative
+    '''
+    if value < 0:
+        raise ValueError('Negative MIDI variable length quantity: ' + str(value))
+        
+    quantity = [value & 0x7f]
+    value >>= 7
+    
+    while value:
+        quantity.append((value & 0x7f) | 0x80)
+        value >>= 7
+        
+    quantity.reverse()
+    return struct.pack('B'*len(quantity),*quantity)
+
+def _write_musicxml_note(output,midi,start,length,measure_ticks,voice):
+    '''
+    Writes a note or rest (midi == REST_MIDI) of write_musicxml, splitting it
+    at each barline and opening measures as they are reached. The parts of a
+    split note are tied, the parts of a split rest are not
+    '''
+    tie_start = False
+    
+    while length > 0:
+        if start % measure_ticks == 0:
+            measure_num = start//measure_ticks + 1
+            if measure_num > 1:
+                output.write('    </measure>\n')
+            output.write('    <measure number="%d">\n' % measure_num)
+            if measure_num == 1:
+                if voice in TREBLE_VOICES:
+                    clef_sign = '<sign>G</sign><line>2</line>'
+                else:
+                    clef_sign = '<sign>F</sign><line>4</line>'
+                output.write('      <attributes><divisions>%d</divisions><key><fifths>0</fifths></key>'
+                             '<time><beats>%d</beats><beat-type>4</beat-type></time><clef>%s</clef></attributes>\n'
+                             % (TICKS_PER_QUARTER,measure_ticks//TICKS_PER_QUARTER,clef_sign))
+                             
+        note_length = min(length,measure_ticks - start%measure_ticks)
+        tie_stop = tie_start
+        tie_start = (note_length < length) and (midi != REST_MIDI)
+        
+        output.write('      <note>')
+        if midi == REST_MIDI:
+            output.write('<rest/>')
+        else:
+            pitch_name = _midi_to_pitch_name(midi)
+            output.write('<pitch><step>%s</step>' % pitch_name[0])
+            if pitch_name[1] == '#':
+                output.write('<alter>1</alter>')
+            elif pitch_name[1] == '-':
+                output.write('<alter>-1</alter>')
+            output.write('<octave>%d</octave></pitch>' % (midi//12 - 1))
+        output.write('<duration>%d</duration>' % note_length)
+        if tie_stop:
+            output.write('<tie type="stop"/>')
+        if tie_start:
+            output.write('<tie type="start"/>')
+        output.write('<voice>1</voice>')
+        if note_length in MUSICXML_NOTE_TYPES:
+            (note_type,dots) = MUSICXML_NOTE_TYPES[note_length]
+            output.write('<type>%s</type>' % note_type + '<dot/>'*dots)
+        if tie_stop or tie_start:
+            output.write('<notations>')
+            if tie_stop:
+                output.write('<tied type="stop"/>')
+            if tie_start:
+                output.write('<tied type="start"/>')
+            output.write('</notations>')
+        output.write('</note>\n')
+        
+        start += note_length
+        length -= note_length
+
+def _get_next_element(model_state):
+    return _draw(_compile_state(model_state))
+
+def _compile_state(model_state):
+    '''
+    Returns the elements of a model state with their cumulative counts
+    as a tuple (elements,cumulative_counts,total)
+    '''
+    elements = []
+    cumulative_counts = []
+    total = 0
+    
+    for key in model_state.keys():
+        total += model_state[key]
+        elements.append(key)
+        cumulative_counts.append(total)
+        
+    return (elements,cumulative_counts,total)
+
+def _draw(compiled_state):
+    '''
+    Draws an element from a compiled model state with a binary search over
+    its cumulative counts. Each element is drawn with probability count/total
+    '''
+    (elements,cumulative_counts,total) = compiled_state
+    i = bisect_right(cumulative_counts,random()*total)
+    
+    return elements[min(i,len(elements)-1)]
+
+def _mask_state(compiled_state,constraint):
+    '''
+    Returns a compiled model state holding only the elements in constraint,
+    with their counts unchanged, or None if no element is allowed
+    '''
+    (elements,cumulative_counts,total) = compiled_state
+    masked_elements = []
+    masked_cumulative_counts = []
+    masked_total = 0
+    prev_count = 0
+    
+    for (element,cumulative_count) in zip(elements,cumulative_counts):
+        if element in constraint:
+            masked_total += cumulative_count - prev_count
+            masked_elements.append(element)
+            masked_cumulative_counts.append(masked_total)
+        prev_count = cumulative_count
+        
+    if not masked_elements:
+        return None
+        
+    return (masked_elements,masked_cumulative_counts,masked_total)
+    
+def _get_next_rows(compact_model):
+    '''
+    Returns an array giving, for each transition of a compact_markov, the row
+    of the state it leads to, or -1 if that state is not in the model
+    '''
+    next_rows = array('i',[-1])*len(compact_model.next_ids)
+    
+    for row in range(compact_model.num_rows()):
+        state = compact_model.get_state(row)
+        
+        for i in range(compact_model.row_starts[row],compact_model.row_starts[row+1]):
+            next_row = compact_model.get_row(state[1:] + (compact_model.next_ids[i],))
+            if next_row != None:
+                next_rows[i] = next_row
+                
+    return next_rows
+
+def _get_reach(compact_model,next_rows,constraint,horizon):
+    '''
+    Returns an array giving, for each row of a compact_markov, the largest number
+    of elements up to horizon that can be drawn one after another from its state
+    without drawing 'NULL' or an element outside constraint (None allows every
+    element). A row of 0 is a dead end and a row of horizon can go on at least
+    horizon elements.
+    
+    The table is found by raising the reach of each row to one more than the
+    best reach of the rows that follow it until no row changes, which takes at
+    most horizon passes over the transitions
+    '''
+    num_rows = compact_model.num_rows()
+    row_starts = compact_model.row_starts
+    next_ids = compact_model.next_ids
+    reach = array('i',[0])*num_rows
+    changed = True
+    
+    while changed:
+        changed = False
+        
+        for row in range(num_rows):
+            best = reach[row]
+            if best >= horizon:
+                continue
+                
+            for i in range(row_starts[row],row_starts[row+1]):
+                next_id = next_ids[i]
+                if (next_id == NULL_ID) or ((constraint != None) and (next_id not in constraint)):
+                    continue
+                    
+                if next_rows[i] >= 0:
+                    best = max(best,min(1 + reach[next_rows[i]],horizon))
+                else:
+                    best = max(best,1)
+                    
+            if best > reach[row]:
+                reach[row] = best
+                changed = True
+                
+    return reach
+
+def _smooth_harmony(harmony_pitches,harmony_durations):
+    '''
+    Given a harmony, _smooth_harmony goes through each part combining
+    consecutive notes with identical pitches and durations into one note.
+    Rests between the notes are skipped over and kept in place. Each
+    part is visited once and nothing is copied.
+    
+    INPUTS:
+        harmony_pitches: midi numbers of the notes of each part, REST_MIDI for a rest
+        harmony_durations: durations in ticks of the notes of each part
+        
+    RETURNS:
+        [pitches,durations] of the parts with the notes combined
+    '''
+    smooth_pitches = []
+    smooth_durations = []
+    
+    for (pitches,durations) in zip(harmony_pitches,harmony_durations):
+        part_pitches = array('h')
+        part_durations = array('i')
+        current_note = None
+        
+        for (midi,ticks) in zip(pitches,durations):
+            if midi == REST_MIDI:
+                part_pitches.append(midi)
+                part_durations.append(ticks)
+            elif (current_note != None) and (part_pitches[current_note] == midi) and (part_durations[current_note] == ticks):
+                part_durations[current_note] += ticks
+            else:
+                current_note = len(part_pitches)
+                part_pitches.append(midi)
+                part_durations.append(ticks)
+                
+        smooth_pitches.append(part_pitches)
+        smooth_durations.append(part_durations)
+        
+    return [smooth_pitches,smooth_durations]
+    
+def _dict_to_file(dict,filename):
+    success = True
+    try:
+        output = open(str(filename) + '.pkl','wb')
+        pickle.dump(dict,output)
+        output.close()
+    except:
+        print 'Error writing to' + str(filename) + '.pkl'
+        success = False
+        
+    return success
+
+def _file_to_dict(filename):
+    rv = {}
+    try:
+        pkl_file = open(str(filename),'rb')
+        rv = pickle.load(pkl_file)
+        pkl_file.close()
+    except:
+        print 'Error reading from' + str(filename) + '.pkl'
+        return None
+
     return rv
     
-def _smooth_harmony(harmony):
+def _dict_to_file_atomic(dict,filename):
+    '''
+    Writes a dictionary to filename by writing a temporary file in the same
+    directory and renaming it, so that readers see either the old file or
+    the complete new file
+    '''
+    temp_filename = filename + '.' + str(os.getpid()) + '.tmp'
+    
+    if not _dict_to_file(dict,temp_filename):
+        return False
+        
+    try:
+        os.rename(temp_filename + '.pkl',filename + '.pkl')
+    except OSError:
+        # os.rename does not replace an existing file on Windows
+        os.remove(temp_filename + '.pkl')
+        return os.path.exists(filename + '.pkl')
+        
+    return True
+
+def _write_binary_model(metadata,arrays,filename):
+    '''
+    Writes a binary model (see BINARY_MODEL_HEADER) to a temporary file and
+    renames it to filename. Processes that have the old file mapped keep
+    reading the old model
+    
+    INPUTS:
+        metadata: dictionary pickled after the header
+        arrays: list of (name,values) of the int32 arrays, in the order
+                given by metadata['arrays']
+    '''
+    temp_filename = filename + '.' + str(os.getpid()) + '.tmp'
+    metadata_bytes = pickle.dumps(metadata,2)
+    header = struct.pack(BINARY_MODEL_HEADER,BINARY_MODEL_MAGIC,BINARY_MODEL_VERSION,len(metadata_bytes))
+    
+    try:
+        output = open(temp_filename,'wb')
+        try:
+            output.write(header)
+            output.write(metadata_bytes)
+            output.write(b'\0'*(_align(len(header) + len(metadata_bytes)) - len(header) - len(metadata_bytes)))
+            
+            for (name,values) in arrays:
+                values = array('i',values)
+                if sys.byteorder == 'big':
+                    values.byteswap()
+                values.tofile(output)
+        finally:
+            output.close()
+            
+        try:
+            os.rename(temp_filename,filename)
+        except OSError:
+            # os.rename does not replace an existing file on Windows
+            os.remove(filename)
+            os.rename(temp_filename,filename)
+    except EnvironmentError:
+        print 'Error writing to ' + str(filename)
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
+        return False
+        
+    return True
+
+def _is_binary_model(filename):
+    try:
+        input = open(filename,'rb')
+        try:
+            return input.read(len(BINARY_MODEL_MAGIC)) == BINARY_MODEL_MAGIC
+        finally:
+            input.close()
+    except EnvironmentError:
+        return False
+
+def _align(offset):
+    return offset + (-offset % BINARY_MODEL_ALIGNMENT)
+
+def _get_mapped_markov(arrays,name,order):
+    return _mapped_markov(order,arrays[name + '.states'],arrays[name + '.row_starts'],
+                          arrays[name + '.next_ids'],arrays[name + '.cumulative_counts'])
+
+def _acquire_lock(lock_filename,timeout):
+    '''
+    Creates lock_filename, waiting while another process holds it. A lock
+    older than timeout seconds is assumed to have been left by a process
+    that died and is removed
+    '''
+    while True:
+        try:
+            fd = os.open(lock_filename,os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            os.write(fd,str(os.getpid()).encode('ascii'))
+            os.close(fd)
+            return
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+                
+        try:
+            if time.time() - os.path.getmtime(lock_filename) > timeout:
+                os.remove(lock_filename)
+                continue
+        except OSError:
+            continue
+            
+        time.sleep(1)
+
+def _release_lock(lock_filename):
+    try:
+        os.remove(lock_filename)
+    except OSError:
+        pass
+
+def _get_corpus_manifest(bwv_nums):
+    '''
+    Returns the sources a model is built from, preceded by the version
+    of music21 whose corpus they are taken from
+    '''
+    return ['music21 ' + str(base.VERSION_STR)] + ['bach/bwv' + str(bwv_num) for bwv_num in bwv_nums]
+    
+def _get_half_steps_from_c(stream):
+    '''
+    Returns the number of half steps, between -5 and 6, from C to the tonic of
+    the major key with the key signature of the analysed key of a stream
+    '''
+    num_sharps = stream.analyze('key').sharps
+    num_half_steps = ((num_sharps*7) % 12)
+    
+    if num_half_steps > 6:
+        num_half_steps = num_half_steps - 12
+        
+    return num_half_steps
+
+def _update_markov(data,markov_model,order):
+    data.append('NULL')
+    num_elements = len(data)
+    
+    for i in range(order):
+        data.insert(0,'NULL')
+        
+    for i in range(num_elements):
+        state = tuple(data[i:i+order])
+        next_state = data[i+order]
+        
+        if state not in markov_model.keys():
+            markov_model[state] = {}
+
+        if next_state not in markov_model[state]:
+            markov_model[state][next_state] = 1
+        else:
+            markov_model[state][next_state] += 1
+            
+    return markov_model
+    
+def _merge_markov(markov_model,other_model):
+    '''
+    Adds the transition counts of other_model to markov_model. States and
+    transitions new to markov_model are added in the order they appear
+    in other_model
+    '''
+    for state in other_model.keys():
+        if state not in markov_model:
+            markov_model[state] = {}
+            
+        for next_state in other_model[state].keys():
+            if next_state not in markov_model[state]:
+                markov_model[state][next_state] = other_model[state][next_state]
+            else:
+                markov_model[state][next_state] += other_model[state][next_state]
+                
+    return markov_model
+    
+def _markov_to_compact(markov_model,order,vocabulary):
+    '''
+    Converts a markov model in the form produced by _update_markov to a
+    compact_markov, interning its elements in vocabulary
+    '''
+    rows = []
+    for state in markov_model.keys():
+        state_ids = tuple([vocabulary.intern(element) for element in state])
+        transitions = sorted([(vocabulary.intern(next_state),markov_model[state][next_state])
+                              for next_state in markov_model[state].keys()])
+        rows.append((state_ids,transitions))
+    rows.sort()
+    
+    states = array('i')
+    row_starts = array('i',[0])
+    next_ids = array('i')
+    cumulative_counts = array('i')
+    
+    for (state_ids,transitions) in rows:
+        states.extend(state_ids)
+        total = 0
+        for (next_id,count) in transitions:
+            total += count
+            next_ids.append(next_id)
+            cumulative_counts.append(total)
+        row_starts.append(len(next_ids))
+        
+    return compact_markov(order,states,row_starts,next_ids,cumulative_counts)
+
+def _compact_to_markov(compact_model,vocabulary):
+    '''
+    Converts a compact_markov back to the form produced by _update_markov
+    '''
+    markov_model = {}
+    elements = vocabulary.elements
+    
+    for row in range(compact_model.num_rows()):
+        state = tuple([elements[x] for x in compact_model.get_state(row)])
+        model_state = {}
+        prev_count = 0
+        
+        for i in range(compact_model.row_starts[row],compact_model.row_starts[row+1]):
+            model_state[elements[compact_model.next_ids[i]]] = compact_model.cumulative_counts[i] - prev_count
+            prev_count = compact_model.cumulative_counts[i]
+            
+        markov_model[state] = model_state
+        
+    return markov_model
+
+def _compile_row(compact_model,row):
+    '''
+    Returns a row of a compact_markov as a compiled model state of element ids
+    '''
+    start = compact_model.row_starts[row]
+    end = compact_model.row_starts[row+1]
+    
+    return (list(compact_model.next_ids[start:end]),
+            list(compact_model.cumulative_counts[start:end]),
+            compact_model.cumulative_counts[end-1])
+
+def _new_trie_node():
+    '''
+    Returns an empty node of a markov trie. A node is a list holding the
+    transition counts for the state ending at the node and the child
+    nodes keyed by the element preceding that state
+    '''
+    return [{},{}]
+
+def _update_markov_trie(data,markov_trie,max_order):
+    '''
+    Counts the transitions of every order from 0 to max_order in a single
+    pass over data. The state of order k for an element is found by walking
+    k nodes down from the root through the preceding elements, most recent
+    first, so all orders share the nodes of their common suffixes
+    '''
+    data = ['NULL' for x in range(max_order)] + list(data) + ['NULL']
+    
+    for i in range(max_order,len(data)):
+        next_state = data[i]
+        node = markov_trie
+        
+        for k in range(max_order+1):
+            if k > 0:
+                children = node[1]
+                if data[i-k] not in children:
+                    children[data[i-k]] = _new_trie_node()
+                node = children[data[i-k]]
+            
+            counts = node[0]
+            if next_state not in counts:
+                counts[next_state] = 1
+            else:
+                counts[next_state] += 1
+                
+    return markov_trie
+
+def _merge_markov_trie(markov_trie,other_trie):
+    '''
+    Adds the transition counts of other_trie to markov_trie
+    '''
+    _merge_markov({():markov_trie[0]},{():other_trie[0]})
+    
+    for element in other_trie[1].keys():
+        if element not in markov_trie[1]:
+            markov_trie[1][element] = _new_trie_node()
+        _merge_markov_trie(markov_trie[1][element],other_trie[1][element])
+        
+    return markov_trie
+
+def _markov_trie_to_dict(markov_trie,order):
+    '''
+    Returns the markov model of a given order stored in a markov trie in
+    the form produced by _update_markov
+    '''
+    markov_model = {}
+    nodes = [((),markov_trie)]
+    
+    for k in range(order):
+        nodes = [((element,) + state,child) for (state,node) in nodes for (element,child) in node[1].items()]
+        
+    for (state,node) in nodes:
+        markov_model[state] = dict(node[0])
+        
+    return markov_model
+
+class _markov_sampler(object):
     '''
-    Given a harmony, _smooth_harmony iterates through each part combining
-    consecutive notes with identical pitches into one note. This function
-    ignores the melody (aka soprano) line.
+    Samples element ids from a compact_markov. Each draw is a single binary
+    search over the cumulative counts of the row of the state. Rows restricted
+    to a constraint are cached per (row,constraint).
+    
+    For each constraint the sampler keeps a reachability table (see _get_reach)
+    giving the number of elements that can still be drawn from each row, so
+    that elements leading to the end of a chorale too soon are never drawn
     '''
-    temp_harmony = copy.deepcopy(harmony)
-    new_harmony = stream.Score()
-    new_harmony.insert(0,temp_harmony.elements[0])
 
-    for (i,harmony_part) in enumerate(temp_harmony.elements[1:]):
-        temp_part = stream.Part()
-        notes_and_rests = harmony_part.notesAndRests
-        current_note = notes_and_rests[0]
+    def __init__(self,compact_model,vocabulary,horizon=REACH_HORIZON):
+        self.model = compact_model
+        self.vocabulary = vocabulary
+        self.horizon = horizon
+        self.masked_states = {}
+        self.reaching_states = {}
+        self.next_rows = None
+        self.reach = {}
         
-        while (current_note != None):
-            next_note = notes_and_rests.getElementAfterElement(current_note,[note.Note])
-            while (next_note != None):
-                if (current_note.fullName != next_note.fullName):
-                    break
-                current_note.quarterLength += next_note.quarterLength
-                notes_and_rests.remove(next_note)
-                next_note = notes_and_rests.getElementAfterElement(current_note,[note.Note])
-                    
-            current_note = notes_and_rests.getElementAfterElement(current_note,[note.Note])  
-
-        for n in notes_and_rests:
-            temp_part.append(n)
-        new_harmony.insert(0,temp_part)
+    def get_reach(self,constraint=None):
+        '''
+        Returns the reachability table of a constraint (see _get_reach)
+        '''
+        if constraint not in self.reach:
+            if self.next_rows == None:
+                self.next_rows = _get_next_rows(self.model)
+            self.reach[constraint] = _get_reach(self.model,self.next_rows,constraint,self.horizon)
+            
+        return self.reach[constraint]
+            
+    def draw(self,state,constraint=None,length=None):
+        '''
+        Draws the id of the element following state, a tuple of element ids.
+        If constraint is a frozenset of ids the element is drawn from the allowed
+        elements of the state, renormalised.
         
-    return new_harmony
-    
-def _dict_to_file(dict,filename):
-    success = True
-    try:
-        output = open(str(filename) + '.pkl','wb')
-        pickle.dump(dict,output)
-        output.close()
-    except:
-        print 'Error writing to' + str(filename) + '.pkl'
-        success = False
+        If length is given only elements that can be followed by length-1 more
+        allowed elements are drawn, renormalised. Lengths beyond the horizon of
+        the sampler are treated as the horizon.
         
-    return success
-
-def _file_to_dict(filename):
-    rv = {}
-    try:
-        pkl_file = open(str(filename),'rb')
-        rv = pickle.load(pkl_file)
-        pkl_file.close()
-    except:
-        print 'Error reading from' + str(filename) + '.pkl'
-        return None
+        Returns None if no element of the state is allowed
+        '''
+        row = self.model.get_row(state)
+        
+        if length != None:
+            return self._draw_reaching(row,constraint,min(length,self.horizon))
+            
+        if constraint == None:
+            start = self.model.row_starts[row]
+            end = self.model.row_starts[row+1]
+            cumulative_counts = self.model.cumulative_counts
+            i = bisect_right(cumulative_counts,random()*cumulative_counts[end-1],start,end)
+            
+            return self.model.next_ids[min(i,end-1)]
+            
+        key = (row,constraint)
+        if key not in self.masked_states:
+            self.masked_states[key] = _mask_state(_compile_row(self.model,row),constraint)
+            
+        masked_state = self.masked_states[key]
+        if masked_state == None:
+            return None
+            
+        return _draw(masked_state)
+        
+    def _draw_reaching(self,row,constraint,length):
+        key = (row,constraint)
+        
+        if key not in self.reaching_states:
+            reach = self.get_reach(constraint)
+            successors = []
+            
+            for i in range(self.model.row_starts[row],self.model.row_starts[row+1]):
+                next_id = self.model.next_ids[i]
+                if (next_id == NULL_ID) or ((constraint != None) and (next_id not in constraint)):
+                    continue
+                    
+                next_row = self.next_rows[i]
+                if next_row >= 0:
+                    successors.append((1 + reach[next_row],next_id))
+                else:
+                    successors.append((0,next_id))
+                    
+            successors.sort()
+            self.reaching_states[key] = (successors,[x[0] for x in successors],{})
+            
+        # The allowed successors only change at the reach of a successor, so
+        # each length is looked up as the first successor reaching it
+        (successors,reaches,masked_states) = self.reaching_states[key]
+        if length <= 1:
+            i = 0
+        else:
+            i = bisect_left(reaches,length)
+            
+        if i not in masked_states:
+            masked_states[i] = _mask_state(_compile_row(self.model,row),set([x[1] for x in successors[i:]]))
+            
+        masked_state = masked_states[i]
+        if masked_state == None:
+            return None
+            
+        return _draw(masked_state)
 
-    return rv
-    
-def _check_if_model_saved(model):
+class _sequence_scorer(object):
     '''
-    Determines if a saved version of the specidied model exists.
-    If so it returns the name of the save file.
+    Finds the log probabilities of sequences under a compact_markov. The log
+    probability of a transition is found from the cumulative counts of its row
+    the first time it is needed and kept in a dictionary keyed by (row,id)
     '''
-    try:
-        for file in os.listdir("."):
-            if file.endswith(".pkl"):
-                file_chord_order = file.strip('.pkl').split('_')[2]
-                file_pitch_order = file.strip('.pkl').split('_')[3]
-                file_offset_order = file.strip('.pkl').split('_')[4]
-                file_model_version = file.strip('.pkl').split('_')[5]
-
-                if ((file_chord_order == str(model.chord_order)) and
-                    (file_pitch_order == str(model.melody_pitch_order)) and
-                    (file_offset_order == str(model.melody_offset_order)) and
-                    (file_model_version == str(CURRENT_VERSION))):
-                    return file
-    except:
-        print 'No saved model found'
-    return None
-    
-def _transpose_to_c(stream):
-    num_sharps = stream.analyze('key').sharps
-    num_half_steps = ((num_sharps*7) % 12)
-    
-    if num_half_steps > 6:
-        num_half_steps = num_half_steps - 12
+
+    def __init__(self,compact_model,vocabulary):
+        self.model = compact_model
+        self.vocabulary = vocabulary
+        self.log_probs = {}
+        
+    def score(self,sequence,floor_log_prob=None,score_end=False):
+        '''
+        Returns the log probability of a sequence of elements, starting from the
+        start of a chorale. Transitions that are not in the model, including those
+        from a state that is not, have the log probability floor_log_prob, or make
+        the sequence -inf if floor_log_prob is None
+        '''
+        ids = self.vocabulary.ids
+        state = tuple([NULL_ID for x in range(self.model.order)])
+        total = 0.0
+        
+        if score_end:
+            sequence = list(sequence) + ['NULL']
+            
+        for element in sequence:
+            next_id = ids.get(element,-1)
+            log_prob = self.get_log_prob(state,next_id)
+            
+            if log_prob == None:
+                if floor_log_prob == None:
+                    return float('-inf')
+                log_prob = floor_log_prob
+                
+            total += log_prob
+            state = (state + (next_id,))[1:]
+            
+        return total
         
-    return stream.transpose(-1*num_half_steps)
+    def get_log_prob(self,state,next_id):
+        '''
+        Returns the log probability of next_id following state, or None if the
+        transition is not in the model
+        '''
+        row = self.model.get_row(state)
+        if row == None:
+            return None
+            
+        key = (row,next_id)
+        if key not in self.log_probs:
+            start = self.model.row_starts[row]
+            end = self.model.row_starts[row+1]
+            i = bisect_left(self.model.next_ids,next_id,start,end)
+            
+            if (i < end) and (self.model.next_ids[i] == next_id):
+                cumulative_counts = self.model.cumulative_counts
+                if i > start:
+                    count = cumulative_counts[i] - cumulative_counts[i-1]
+                else:
+                    count = cumulative_counts[i]
+                self.log_probs[key] = math.log(float(count)/cumulative_counts[end-1])
+            else:
+                self.log_probs[key] = None
+                
+        return self.log_probs[key]
 
-def _update_markov(data,markov_model,order):
-    data.append('NULL')
-    num_elements = len(data)
+def _index_chords_by_pitch(compiled_state,vocabulary):
+    '''
+    Splits a compiled chord model state into one compiled state per pitch class,
+    each holding the ids of the chords that contain the pitch class, so that
+    enharmonic spellings of a note find the same chords
+    '''
+    (chord_ids,cumulative_counts,total) = compiled_state
+    states_by_pitch = {}
+    prev_count = 0
     
-    for i in range(order):
-        data.insert(0,'NULL')
+    for (chord_id,cumulative_count) in zip(chord_ids,cumulative_counts):
+        count = cumulative_count - prev_count
+        prev_count = cumulative_count
         
-    for i in range(num_elements):
-        state = tuple(data[i:i+order])
-        next_state = data[i+order]
+        if chord_id == NULL_ID:
+            continue
+            
+        for pitch_name in vocabulary.elements[chord_id]:
+            pitch_class = _pitch_name_to_midi(pitch_name)%12
+            if pitch_class not in states_by_pitch:
+                states_by_pitch[pitch_class] = {}
+            states_by_pitch[pitch_class][chord_id] = count
+            
+    compiled_states = {}
+    for pitch_class in states_by_pitch.keys():
+        compiled_states[pitch_class] = _compile_state(states_by_pitch[pitch_class])
         
-        if state not in markov_model.keys():
-            markov_model[state] = {}
+    return compiled_states
 
-        if next_state not in markov_model[state]:
-            markov_model[state][next_state] = 1
+class _chord_index(object):
+    '''
+    A chord markov model indexed by (state,pitch class). Each entry holds the
+    compiled distribution of the ids of the chords that follow the state and
+    contain the pitch class. A state is indexed the first time it is looked up,
+    so only the states that generation reaches are ever compiled. The chord
+    weights are indexed by pitch class in the same way and are used when the
+    state has no chord containing the pitch class
+    '''
+
+    def __init__(self,chord_model,chord_weights,vocabulary):
+        self.chord_model = chord_model
+        self.vocabulary = vocabulary
+        self.states = {}
+        self.indexed_states = set()
+        
+        if chord_weights.num_rows() > 0:
+            self.weights = _index_chords_by_pitch(_compile_row(chord_weights,0),vocabulary)
         else:
-            markov_model[state][next_state] += 1
+            self.weights = {}
             
-    return markov_model
+    def get_state(self,state,pitch_class):
+        '''
+        Returns the compiled distribution of the chords containing pitch_class that
+        follow state, or None if the chord model has no such chord
+        '''
+        if state not in self.indexed_states:
+            self.indexed_states.add(state)
+            row = self.chord_model.get_row(state)
+            
+            if row != None:
+                compiled_states = _index_chords_by_pitch(_compile_row(self.chord_model,row),self.vocabulary)
+                for pc in compiled_states.keys():
+                    self.states[(state,pc)] = compiled_states[pc]
+                    
+        return self.states.get((state,pitch_class))
+        
+    def draw(self,state,pitch_class):
+        '''
+        Draws the id of a chord containing pitch_class that follows state, a tuple
+        of chord ids. Returns None if no chord in the model contains pitch_class
+        '''
+        compiled_state = self.get_state(state,pitch_class)
+        
+        if compiled_state == None:
+            compiled_state = self.weights.get(pitch_class)
+            if compiled_state == None:
+                return None
+                
+        return _draw(compiled_state)
+
+class generation_stats(object):
+    '''
+    An opt-in record of where the time goes when building models and generating
+    music. Pass one as the stats parameter of gen_model, gen_melody or gen_harmony.
     
+    timings holds the total seconds spent in each phase, counts the total of each
+    counter (retries, failures and fallbacks) and chorales the number and time of
+    each chorale added to a model. If hook is given it is called as hook(event,data)
+    with each record as it is made, where event is 'time', 'count' or 'chorale'
+    and data is a dictionary
+    '''
+    
+    def __init__(self,hook=None):
+        self.hook = hook
+        self.timings = {}
+        self.counts = {}
+        self.chorales = []
+        
+    def add_time(self,phase,start_time):
+        '''
+        Adds the time since start_time to phase and returns the current time,
+        which can be passed as the start time of the next phase
+        '''
+        now = time.time()
+        self.timings[phase] = self.timings.get(phase,0.0) + (now - start_time)
+        self._report('time',{'phase':phase,'seconds':now - start_time})
+        
+        return now
+        
+    def add_count(self,name,n=1):
+        self.counts[name] = self.counts.get(name,0) + n
+        self._report('count',{'name':name,'n':n})
+        
+    def add_chorale(self,bwv_num,seconds):
+        record = {'num':len(self.chorales) + 1,'bwv':bwv_num,'seconds':seconds}
+        self.chorales.append(record)
+        self._report('chorale',record)
+        
+    def merge(self,other):
+        '''
+        Adds the records of another generation_stats, reporting its chorales
+        to the hook
+        '''
+        for phase in other.timings.keys():
+            self.timings[phase] = self.timings.get(phase,0.0) + other.timings[phase]
+        for name in other.counts.keys():
+            self.counts[name] = self.counts.get(name,0) + other.counts[name]
+        for record in other.chorales:
+            self.add_chorale(record['bwv'],record['seconds'])
+            
+    def _report(self,event,data):
+        if self.hook != None:
+            self.hook(event,data)
+
 class chorale_model(object):
 
     def __init__(self,c_order,m_p_order,m_o_order):
@@ -606,8 +2807,67 @@ class chorale_model(object):
         self.melody_offset_model = {}
         self.chord_model = {}
         self.chord_weights = {}
+        self.chord_table = {}
+        self.manifest = []
+        self.samplers = None
+        
+    def __getstate__(self):
+        # The samplers hold caches filled during generation, so they are
+        # compiled again rather than pickled
+        state = dict(self.__dict__)
+        state['samplers'] = None
+        return state
+        
+    def get_samplers(self):
+        '''
+        Returns a dictionary of the compiled melody pitch and melody offset
+        models, the chord index, the chord table and the vocabulary of the
+        compact form of the model. The models are compiled on first use and recompiled after the
+        model changes
+        '''
+        if self.samplers == None:
+            self.samplers = self.to_compact().get_samplers()
+            
+        return self.samplers
         
-    def save_model(self):
+    def to_compact(self):
+        '''
+        Returns the model as a compact_chorale_model
+        '''
+        compact_model = compact_chorale_model(self.chord_order,self.melody_pitch_order,self.melody_offset_order)
+        vocabulary = compact_model.vocabulary
+        
+        compact_model.melody_pitch_model = _markov_to_compact(self.melody_pitch_model,self.melody_pitch_order,vocabulary)
+        compact_model.melody_offset_model = _markov_to_compact(self.melody_offset_model,self.melody_offset_order,vocabulary)
+        compact_model.chord_model = _markov_to_compact(self.chord_model,self.chord_order,vocabulary)
+        compact_model.chord_weights = _markov_to_compact(self.chord_weights,0,vocabulary)
+        compact_model.chord_table = dict(self.chord_table)
+        compact_model.manifest = list(self.manifest)
+        
+        return compact_model
+        
+    def save_binary(self,filename):
+        '''
+        Saves the compact form of the model in the binary format read by
+        open_binary_model (see compact_chorale_model.save_binary)
+        '''
+        return self.to_compact().save_binary(filename)
+        
+    def get_model_key(self):
+        '''
+        Returns the key under which the model is saved in a model_store: a hash of
+        the orders of the model, CURRENT_VERSION, EXTRACTOR_VERSION and the manifest
+        of the corpus the model is built from
+        '''
+        key = (self.chord_order,self.melody_pitch_order,self.melody_offset_order,
+               CURRENT_VERSION,EXTRACTOR_VERSION,tuple(self.manifest))
+        
+        return hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+        
+    def save_model(self,store=None):
+        '''
+        Saves the model in a model_store, by default the one in MODEL_STORE_DIR
+        '''
         output = {}
         
         output['chord_order'] = self.chord_order
@@ -617,21 +2877,32 @@ class chorale_model(object):
         output['melody_offset_model'] = self.melody_offset_model
         output['chord_model'] = self.chord_model
         output['chord_weights'] = self.chord_weights
+        output['chord_table'] = self.chord_table
+        output['manifest'] = self.manifest
         
-        filename = ('chorale_model_' + str(self.chord_order) + 
-                    '_' + str(self.melody_pitch_order) + 
-                    '_' + str(self.melody_offset_order) + 
-                    '_' + str(CURRENT_VERSION))
+        if store == None:
+            store = model_store()
         
-        if _dict_to_file(output,filename):
+        if store.save(self.get_model_key(),output):
             print 'Model successfully saved'
 
         else:
             print 'Error saving model'
         
-    def load_model(self,filename):
+    def load_model(self,filename=None,store=None):
+        '''
+        Loads a model saved in a pickle file. If no filename is given the model
+        with the same key is loaded from a model_store, by default the one in
+        MODEL_STORE_DIR. Returns None if the model could not be loaded
+        '''
         success = True
-        input = _file_to_dict(filename)
+        
+        if filename != None:
+            input = _file_to_dict(filename)
+        else:
+            if store == None:
+                store = model_store()
+            input = store.load(self.get_model_key())
         
         if input:
             try:
@@ -642,6 +2913,13 @@ class chorale_model(object):
                 self.melody_offset_model = input['melody_offset_model']
                 self.chord_model = input['chord_model']
                 self.chord_weights = input['chord_weights']
+                self.manifest = input.get('manifest',[])
+                self.samplers = None
+                
+                # Models saved before chord tables were kept get one from their chord weights
+                self.chord_table = input.get('chord_table',{})
+                for model_state in self.chord_weights.values():
+                    _update_chord_table(self.chord_table,model_state.keys())
             except:
                 print 'Error loading model'
                 return None
@@ -651,55 +2929,557 @@ class chorale_model(object):
         else:
             return None
         
-    def add_chords_to_model(self,s):
-        try:
-            satb_stream = stream.Score()
-            satb_stream.insert(0, s.getElementById('Soprano'))
-            satb_stream.insert(0, s.getElementById('Alto'))
-            satb_stream.insert(0, s.getElementById('Tenor'))
-            satb_stream.insert(0, s.getElementById('Bass'))
-        except:
-            return
+    def merge_model(self,other):
+        '''
+        Adds the transition counts of another model with the same orders
+        to this model
+        '''
+        self.melody_pitch_model = _merge_markov(self.melody_pitch_model,other.melody_pitch_model)
+        self.melody_offset_model = _merge_markov(self.melody_offset_model,other.melody_offset_model)
+        self.chord_model = _merge_markov(self.chord_model,other.chord_model)
+        self.chord_weights = _merge_markov(self.chord_weights,other.chord_weights)
+        self.chord_table.update(other.chord_table)
+        self.samplers = None
+        
+    def add_features_to_model(self,features):
+        '''
+        Adds the sequences extracted from a chorale (see _get_chorale_features)
+        to the model
+        '''
+        if features['melody_pitches'] != None:
+            self.melody_pitch_model = _update_markov(list(features['melody_pitches']),self.melody_pitch_model,self.melody_pitch_order)
+            
+        if features['melody_offsets'] != None:
+            self.melody_offset_model = _update_markov(list(features['melody_offsets']),self.melody_offset_model,self.melody_offset_order)
+            
+        if features['chords'] != None:
+            chords = list(features['chords'])
+            self.chord_model = _update_markov(chords,self.chord_model,self.chord_order)
+            self.chord_weights = _update_markov(chords,self.chord_weights,0)
+            _update_chord_table(self.chord_table,chords)
+            
+        self.samplers = None
         
-        parsed_chords = _transpose_to_c(satb_stream.chordify().flat.getElementsByClass('Chord'))
-        chords = []
+    def add_chorale_to_model(self,s):
+        '''
+        Adds a chorale given as a music21 stream with parts 'Soprano', 'Alto',
+        'Tenor' and 'Bass' to the model (see _extract_features)
+        '''
+        self.add_features_to_model(_extract_features(s))
         
-        if parsed_chords == None:
+    def add_score(self,source):
+        '''
+        Adds four part scores to the model, so a model can be updated without
+        being rebuilt from the whole corpus
+        
+        INPUTS:
+            source: the filename of a score in any format music21 can parse
+                    (MusicXML, MIDI, ...), a directory of such files, or a
+                    music21 stream. The parts are found by their names 'Soprano',
+                    'Alto', 'Tenor' and 'Bass', or failing that a score of exactly
+                    four parts is read as soprano, alto, tenor and bass from the
+                    top down
+                    
+        Each score is recorded in the manifest by the SHA-1 hash of its file (or
+        of its sequences for a stream) and a score already in the manifest is
+        skipped. The key of the model changes with its manifest, so save_model
+        saves the updated model alongside the old one.
+        
+        RETURNS:
+            the number of scores added
+        '''
+        return _add_scores(self,source)
+        
+    def add_chords_to_model(self,s):
+        chords = _extract_chords(s)
+        
+        if chords == None:
             return
-            
-        for chord in parsed_chords:
-            if chord.duration.quarterLength >= 1.0:
-                chord_pitches = tuple(sorted(set([str(element.name) for element in chord.pitches])))
-                if len(chord_pitches) >= 3:
-                    chords.append(chord_pitches)
         
         self.chord_model = _update_markov(chords,self.chord_model,self.chord_order)
         self.chord_weights = _update_markov(chords,self.chord_weights,0)
+        _update_chord_table(self.chord_table,chords)
+        self.samplers = None
 
     def add_melody_pitches_to_model(self,s):
-        try:
-            soprano_stream = s.getElementById('Soprano').flat.notesAndRests
-        except:
+        melody_pitches = _extract_melody_pitches(s)
+        
+        if melody_pitches == None:
             return
-            
-        melody_pitches = []
-    
-        for element in _transpose_to_c(soprano_stream):
-            if element.isRest:
-                melody_pitches.append('REST')
-            elif element.isNote:
-                melody_pitches.append(str(element.pitch))
         
         self.melody_pitch_model = _update_markov(melody_pitches,self.melody_pitch_model,self.melody_pitch_order)
+        self.samplers = None
         
     def add_melody_offsets_to_model(self,s):
-        try:
-            soprano_stream = s.getElementById('Soprano').flat.notesAndRests
-        except:
+        melody_offsets = _extract_melody_offsets(s)
+        
+        if melody_offsets == None:
             return
 
-        melody_offsets = [element.offset for element in soprano_stream]
-
         self.melody_offset_model = _update_markov(melody_offsets,self.melody_offset_model,self.melody_offset_order)
+        self.samplers = None
+
+class model_store(object):
+    '''
+    A directory of saved models. A model is saved as <key>.pkl where key is its
+    get_model_key(), so finding a saved model is a single file lookup and a model
+    built from a different corpus or by a different version of this module is
+    never loaded in its place. The file index.pkl records the orders, versions
+    and manifest of every saved model.
+    
+    Models are written to a temporary file and renamed into place, and the index
+    is updated under a lock file, so processes sharing the directory never see a
+    partially written model. Builders can hold a lock on a key (see gen_model)
+    so that a model is only built once
+    '''
+
+    def __init__(self,directory=MODEL_STORE_DIR):
+        self.directory = directory
+        
+    def get_filename(self,key):
+        return os.path.join(self.directory,key)
+        
+    def load(self,key):
+        '''
+        Returns the dictionary saved under key, or None if there is none
+        '''
+        filename = self.get_filename(key) + '.pkl'
+        
+        if not os.path.exists(filename):
+            return None
+            
+        return _file_to_dict(filename)
+        
+    def save(self,key,model_dict):
+        '''
+        Saves a model dictionary under key and records it in the index
+        '''
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                pass
+                
+        if not _dict_to_file_atomic(model_dict,self.get_filename(key)):
+            return False
+            
+        entry = {}
+        entry['chord_order'] = model_dict['chord_order']
+        entry['melody_pitch_order'] = model_dict['melody_pitch_order']
+        entry['melody_offset_order'] = model_dict['melody_offset_order']
+        entry['model_version'] = CURRENT_VERSION
+        entry['extractor_version'] = EXTRACTOR_VERSION
+        entry['manifest'] = model_dict['manifest']
+        entry['saved'] = time.time()
+        
+        self.lock('index')
+        try:
+            index = self.get_index()
+            index[key] = entry
+            success = _dict_to_file_atomic(index,self.get_filename('index'))
+        finally:
+            self.unlock('index')
+            
+        return success
+        
+    def get_index(self):
+        '''
+        Returns a dictionary with an entry for every saved model, keyed by model key
+        '''
+        index = self.load('index')
+        
+        if index == None:
+            return {}
+            
+        return index
+        
+    def lock(self,key,timeout=MODEL_LOCK_TIMEOUT):
+        '''
+        Takes the lock for key, waiting while another process holds it
+        '''
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                pass
+                
+        _acquire_lock(self.get_filename(key) + '.lock',timeout)
+        
+    def unlock(self,key):
+        _release_lock(self.get_filename(key) + '.lock')
+
+class model_vocabulary(object):
+    '''
+    Interns the pitches, offsets and chords of a model to small ints.
+    'NULL' is always interned as NULL_ID
+    '''
+
+    def __init__(self):
+        self.elements = []
+        self.ids = {}
+        self.intern('NULL')
+        
+    def intern(self,element):
+        if element not in self.ids:
+            self.ids[element] = len(self.elements)
+            self.elements.append(element)
+            
+        return self.ids[element]
+        
+    def get_id_set(self,elements):
+        '''
+        Returns a frozenset of the ids of those elements that are in the vocabulary
+        '''
+        return frozenset([self.ids[element] for element in elements if element in self.ids])
+
+class compact_markov(object):
+    '''
+    A markov model of interned elements stored in arrays. Each state of the
+    model is a row. Rows are sorted by state, and the state of row i is
+    states[i*order:(i+1)*order]. The ids of the elements following the state
+    of row i are next_ids[row_starts[i]:row_starts[i+1]] in increasing order,
+    and cumulative_counts holds their counts summed from the start of the row
+    '''
+
+    def __init__(self,order,states,row_starts,next_ids,cumulative_counts):
+        self.order = order
+        self.states = states
+        self.row_starts = row_starts
+        self.next_ids = next_ids
+        self.cumulative_counts = cumulative_counts
+        self.rows = None
+        
+    def num_rows(self):
+        return len(self.row_starts) - 1
+        
+    def get_state(self,row):
+        return tuple(self.states[row*self.order:(row+1)*self.order])
+        
+    def get_row(self,state):
+        '''
+        Returns the row of a state given as a tuple of element ids, or None
+        if the state is not in the model
+        '''
+        if self.rows == None:
+            self.rows = {}
+            for row in range(self.num_rows()):
+                self.rows[self.get_state(row)] = row
+                
+        return self.rows.get(state)
+
+class _mapped_markov(compact_markov):
+    '''
+    A compact_markov whose arrays are _mapped_arrays. A row is found by a binary
+    search over the sorted states rather than in a dictionary of every state, so
+    nothing is built when the model is opened
+    '''
+    
+    def get_row(self,state):
+        low = 0
+        high = self.num_rows()
+        
+        while low < high:
+            middle = (low + high)//2
+            if self.get_state(middle) < state:
+                low = middle + 1
+            else:
+                high = middle
+                
+        if (low < self.num_rows()) and (self.get_state(low) == state):
+            return low
+            
+        return None
+
+class _mapped_array(object):
+    '''
+    A read only array of the little endian int32s at offset in a _model_file.
+    Items are unpacked from the mapped file as they are read, so nothing is
+    copied when the file is opened. Slices are returned as tuples
+    '''
+    item = struct.Struct('<i')
+    
+    def __init__(self,model_file,offset,length):
+        self.model_file = model_file
+        self.buffer = model_file.buffer
+        self.offset = offset
+        self.length = length
+        
+    def __len__(self):
+        return self.length
+        
+    def __getitem__(self,i):
+        if isinstance(i,slice):
+            (start,stop,step) = i.indices(self.length)
+            if step != 1:
+                return tuple([self[x] for x in range(start,stop,step)])
+            return struct.unpack_from('<' + str(max(stop - start,0)) + 'i',self.buffer,self.offset + 4*start)
+            
+        if i < 0:
+            i += self.length
+        if (i < 0) or (i >= self.length):
+            raise IndexError('mapped array index out of range')
+            
+        return self.item.unpack_from(self.buffer,self.offset + 4*i)[0]
+        
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state['buffer']
+        return state
+        
+    def __setstate__(self,state):
+        self.__dict__.update(state)
+        self.buffer = self.model_file.buffer
+
+class _model_file(object):
+    '''
+    A file mapped read only into memory. Pickling it pickles only its filename,
+    and unpickling maps the file again, so the pages of a model sent to worker
+    processes are shared through the page cache rather than copied
+    '''
+    
+    def __init__(self,filename):
+        self.filename = os.path.abspath(filename)
+        input = open(self.filename,'rb')
+        try:
+            self.buffer = mmap.mmap(input.fileno(),0,access=mmap.ACCESS_READ)
+        finally:
+            input.close()
+            
+    def __getstate__(self):
+        return {'filename':self.filename}
+        
+    def __setstate__(self,state):
+        self.__init__(state['filename'])
+
+class compact_chorale_model(object):
+    '''
+    A chorale_model whose elements are interned in a model_vocabulary and whose
+    markov models are stored as compact_markovs. It can be passed to gen_melody
+    and gen_harmony in place of a chorale_model
+    '''
+
+    def __init__(self,c_order,m_p_order,m_o_order):
+        self.chord_order = c_order
+        self.melody_pitch_order = m_p_order
+        self.melody_offset_order = m_o_order
+        self.vocabulary = model_vocabulary()
+        self.manifest = []
+        self.melody_pitch_model = None
+        self.melody_offset_model = None
+        self.chord_model = None
+        self.chord_weights = None
+        self.chord_table = {}
+        self.reach_tables = []
+        self.samplers = None
+        
+    def __getstate__(self):
+        # The samplers hold caches filled during generation, so they are
+        # compiled again rather than pickled. The reachability tables of a
+        # binary model are mapped arrays and pickle as their offsets
+        state = dict(self.__dict__)
+        state['samplers'] = None
+        return state
+        
+    def get_samplers(self):
+        '''
+        Returns a dictionary of the compiled melody pitch and melody offset
+        models, the chord index, the chord table and the vocabulary of the model.
+        The reachability tables read from a binary model are handed to the
+        samplers so they are not computed again
+        '''
+        if self.samplers == None:
+            self.samplers = {}
+            self.samplers['vocabulary'] = self.vocabulary
+            self.samplers['chord_table'] = self.chord_table
+            self.samplers['melody_pitch'] = _markov_sampler(self.melody_pitch_model,self.vocabulary)
+            self.samplers['melody_offset'] = _markov_sampler(self.melody_offset_model,self.vocabulary)
+            self.samplers['chord'] = _chord_index(self.chord_model,self.chord_weights,self.vocabulary)
+            
+            for (name,constraint,next_rows,reach) in self.reach_tables:
+                self.samplers[name].next_rows = next_rows
+                self.samplers[name].reach[constraint] = reach
+            
+        return self.samplers
+        
+    def to_chorale_model(self):
+        '''
+        Returns the model as a chorale_model
+        '''
+        model = chorale_model(self.chord_order,self.melody_pitch_order,self.melody_offset_order)
+        model.melody_pitch_model = _compact_to_markov(self.melody_pitch_model,self.vocabulary)
+        model.melody_offset_model = _compact_to_markov(self.melody_offset_model,self.vocabulary)
+        model.chord_model = _compact_to_markov(self.chord_model,self.vocabulary)
+        model.chord_weights = _compact_to_markov(self.chord_weights,self.vocabulary)
+        model.chord_table = dict(self.chord_table)
+        model.manifest = list(self.manifest)
+        
+        return model
+        
+    def save_binary(self,filename):
+        '''
+        Saves the model in the binary format read by open_binary_model. The
+        reachability tables of the melody samplers are computed first and saved
+        with the model, so a process opening the file can generate at once.
+        Returns True if the model was saved
+        '''
+        samplers = self.get_samplers()
+        samplers['melody_pitch'].get_reach(self.vocabulary.get_id_set([_midi_to_pitch_name(x) for x in RANGES[SOPRANO]]))
+        samplers['melody_offset'].get_reach(None)
+        
+        arrays = []
+        tables = [('melody_pitch_model',self.melody_pitch_model),('melody_offset_model',self.melody_offset_model),
+                  ('chord_model',self.chord_model),('chord_weights',self.chord_weights)]
+        for (name,compact_model) in tables:
+            arrays.append((name + '.states',compact_model.states))
+            arrays.append((name + '.row_starts',compact_model.row_starts))
+            arrays.append((name + '.next_ids',compact_model.next_ids))
+            arrays.append((name + '.cumulative_counts',compact_model.cumulative_counts))
+            
+        reach = []
+        for name in ['melody_pitch','melody_offset']:
+            sampler = samplers[name]
+            arrays.append((name + '.next_rows',sampler.next_rows))
+            
+            for constraint in sampler.reach.keys():
+                array_name = name + '.reach.' + str(len(reach))
+                arrays.append((array_name,sampler.reach[constraint]))
+                if constraint != None:
+                    reach.append((name,tuple(sorted(constraint)),array_name))
+                else:
+                    reach.append((name,None,array_name))
+                    
+        metadata = {}
+        metadata['orders'] = (self.chord_order,self.melody_pitch_order,self.melody_offset_order)
+        metadata['vocabulary'] = list(self.vocabulary.elements)
+        metadata['manifest'] = list(self.manifest)
+        metadata['chord_table'] = dict(self.chord_table)
+        metadata['horizon'] = samplers['melody_pitch'].horizon
+        metadata['reach'] = reach
+        metadata['arrays'] = [(name,len(values)) for (name,values) in arrays]
+        
+        return _write_binary_model(metadata,arrays,filename)
+
+class multi_order_model(object):
+    '''
+    Holds the melody pitch, melody offset and chord markov models of every
+    order up to a maximum order. The transition counts of all orders are
+    stored in one trie per component and are counted in a single pass
+    over each sequence
+    '''
+
+    def __init__(self,max_c_order,max_m_p_order,max_m_o_order):
+        self.max_chord_order = max_c_order
+        self.max_melody_pitch_order = max_m_p_order
+        self.max_melody_offset_order = max_m_o_order
+        self.melody_pitch_trie = _new_trie_node()
+        self.melody_offset_trie = _new_trie_node()
+        self.chord_trie = _new_trie_node()
+        self.manifest = []
+        
+    def get_model(self,chord_order,pitch_order,offset_order):
+        '''
+        Returns a chorale_model of the given orders. The returned model is
+        identical to one built by gen_model with the same orders
+        '''
+        if ((chord_order > self.max_chord_order) or
+            (pitch_order > self.max_melody_pitch_order) or
+            (offset_order > self.max_melody_offset_order)):
+            print 'Requested order exceeds the maximum order of the model'
+            return None
+            
+        model = chorale_model(chord_order,pitch_order,offset_order)
+        model.manifest = list(self.manifest)
+        model.melody_pitch_model = _markov_trie_to_dict(self.melody_pitch_trie,pitch_order)
+        model.melody_offset_model = _markov_trie_to_dict(self.melody_offset_trie,offset_order)
+        model.chord_model = _markov_trie_to_dict(self.chord_trie,chord_order)
+        
+        # chorale_model counts its chord weights after the chord sequence has been padded
+        # for the chord model, so every chord sequence adds chord_order + 2 'NULL's
+        chord_weights = dict(self.chord_trie[0])
+        if 'NULL' in chord_weights:
+            chord_weights['NULL'] *= chord_order + 2
+        model.chord_weights = {():chord_weights}
+        _update_chord_table(model.chord_table,chord_weights.keys())
+        
+        return model
+        
+    def merge_model(self,other):
+        self.melody_pitch_trie = _merge_markov_trie(self.melody_pitch_trie,other.melody_pitch_trie)
+        self.melody_offset_trie = _merge_markov_trie(self.melody_offset_trie,other.melody_offset_trie)
+        self.chord_trie = _merge_markov_trie(self.chord_trie,other.chord_trie)
+        
+    def add_features_to_model(self,features):
+        if features['melody_pitches'] != None:
+            self.melody_pitch_trie = _update_markov_trie(features['melody_pitches'],self.melody_pitch_trie,self.max_melody_pitch_order)
+            
+        if features['melody_offsets'] != None:
+            self.melody_offset_trie = _update_markov_trie(features['melody_offsets'],self.melody_offset_trie,self.max_melody_offset_order)
+            
+        if features['chords'] != None:
+            self.chord_trie = _update_markov_trie(features['chords'],self.chord_trie,self.max_chord_order)
+            
+    def add_chorale_to_model(self,s):
+        self.add_features_to_model(_extract_features(s))
+        
+    def add_score(self,source):
+        '''
+        Adds four part scores to the model (see chorale_model.add_score)
+        '''
+        return _add_scores(self,source)
 
-    
\ No newline at end of file
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generates music from a saved model')
+    parser.add_argument('command',choices=['melody','harmony','convert'],help='what to generate, or convert to save the model in the binary format')
+    parser.add_argument('model',help='saved model, a binary model or a pickle file')
+    parser.add_argument('output',help='file to write, or directory if --count is more than 1')
+    parser.add_argument('--length',type=int,default=32,help='notes in each piece')
+    parser.add_argument('--count',type=int,default=1,help='number of pieces')
+    parser.add_argument('--seed',type=int,help='seed of the random number generator')
+    parser.add_argument('--format',choices=['midi','musicxml'],default='midi')
+    args = parser.parse_args()
+    
+    model = open_model(args.model)
+    if model == None:
+        sys.exit(1)
+        
+    if args.command == 'convert':
+        if not model.save_binary(args.output):
+            sys.exit(1)
+        sys.exit(0)
+        
+    if args.seed != None:
+        _random.seed(args.seed)
+        
+    pieces = []
+    
+    if args.command == 'harmony':
+        # A melody that cannot be harmonised is replaced by a new one
+        for i in range(args.count):
+            for attempt in range(1000):
+                melody = list(iter_melody(model,args.length))
+                harmony = list(iter_harmony(model,melody,len(melody)))
+                if len(harmony) == len(melody):
+                    break
+            else:
+                sys.exit(1)
+                
+            pieces.append(harmony_to_events(harmony,smooth=True))
+    else:
+        melodies = gen_melodies(model,args.count,args.length)
+        if melodies == None:
+            sys.exit(1)
+            
+        (pitches,durations) = melodies
+        for i in range(args.count):
+            piece = slice(i*args.length,(i+1)*args.length)
+            pieces.append(melody_to_events(pitches[piece],durations[piece]))
+            
+    if args.count > 1:
+        success = write_pieces(pieces,args.output,args.format) != None
+    elif args.format == 'midi':
+        success = write_midi(pieces[0],args.output)
+    else:
+        success = write_musicxml(pieces[0],args.output)
+        
+    if not success:
+        sys.exit(1)
@@ -0,0 +1,361 @@
+'''
+A local server that keeps models loaded and generates music on request
+
+The server listens for HTTP requests on 127.0.0.1. Models are loaded once when
+the server starts and handed to a pool of worker processes, so a request pays
+only for generation. Requests arriving together are batched and sent to the
+pool in one go. Each request may carry a seed, and the same seed always gives
+the same music.
+
+REQUESTS:
+    GET /models
+        returns {"models": [names]}
+    POST /melody with JSON {"model": name, "length": notes, "seed": n, "format": f}
+        generates a melody with bach.iter_melody
+    POST /harmony with JSON {"model": name, "length": notes, "seed": n, "format": f}
+        generates a melody and harmonises it. {"melody": [[pitch,duration],...]}
+        harmonises a given melody instead, with pitches as midi numbers and
+        durations in ticks
+
+    "model" may be left out if the server has one model, "seed" is chosen by the
+    server if left out, and "format" is "events" (the default) or "midi".
+    Lengths and melodies are limited to MAX_LENGTH notes, and melody pitches
+    must be from 0 to 127 or bach.REST_MIDI with positive durations.
+    Responses are JSON holding the seed and either "events", a list of
+    [voice,pitch,start,length], or "midi", a base64 encoded MIDI file. A request
+    that cannot be served returns {"error": message}
+
+USAGE:
+    python bach_server.py [--port PORT] [--workers N] name=model.bin ...
+
+    Models are opened with bach.open_model, so they may be binary models or
+    pickle files. Workers map a binary model rather than copy it
+'''
+import sys
+import json
+import time
+import base64
+import random
+import urllib2
+import argparse
+import threading
+import multiprocessing
+from Queue import Queue,Empty
+from SocketServer import ThreadingMixIn
+from BaseHTTPServer import HTTPServer,BaseHTTPRequestHandler
+
+import bach
+
+'''
+CONSTANTS
+'''
+SERVER_HOST = '127.0.0.1'
+SERVER_PORT = 8421
+MAX_BATCH_SIZE = 32
+BATCH_WAIT = 0.005
+MAX_SEED = 2**31 - 1
+MAX_LENGTH = 1024
+
+_worker_models = {}
+
+'''
+PUBLIC FUNCTIONS
+'''
+def load_models(filenames):
+    '''
+    Loads saved models, binary models or pickle files (see bach.open_model)
+
+    INPUTS:
+        filenames: dictionary of model name to filename
+
+    RETURNS:
+        dictionary of model name to model, or None if a model could not
+        be loaded
+    '''
+    models = {}
+
+    for name in filenames.keys():
+        model = bach.open_model(filenames[name])
+        if model == None:
+            print 'Unable to load model ' + name + ' from ' + filenames[name]
+            return None
+        models[name] = model
+
+    return models
+
+def start_server(models,port=SERVER_PORT,workers=1,host=SERVER_HOST):
+    '''
+    Starts a generation_server in a background thread and returns it. Pass
+    port=0 to listen on any free port, which is then server.server_port. The
+    server is stopped with server.stop()
+    '''
+    server = generation_server(models,port,workers,host)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    return server
+
+def client_request(port,path,params=None,host=SERVER_HOST):
+    '''
+    Sends a request to a generation_server and returns the decoded JSON
+    response. The request is a GET if params == None and otherwise a POST of
+    params as JSON. Error responses are returned like any other
+    '''
+    url = 'http://' + host + ':' + str(port) + path
+
+    if params == None:
+        request = urllib2.Request(url)
+    else:
+        request = urllib2.Request(url,json.dumps(params).encode('utf-8'),{'Content-Type':'application/json'})
+
+    try:
+        response = urllib2.urlopen(request)
+    except urllib2.HTTPError as e:
+        response = e
+
+    try:
+        return json.loads(response.read().decode('utf-8'))
+    finally:
+        response.close()
+
+def decode_midi(response):
+    '''
+    Returns the bytes of the MIDI file in a response with format "midi"
+    '''
+    return base64.b64decode(response['midi'])
+
+'''
+PRIVATE FUNCTIONS
+'''
+def _init_worker(models):
+    '''
+    Keeps the models in a worker process and compiles their samplers once
+    '''
+    _worker_models.clear()
+    _worker_models.update(models)
+
+    for model in _worker_models.values():
+        model.get_samplers()
+
+def _run_job(job):
+    '''
+    Generates the music of one request in a worker process. Returns
+    (response,None) or (None,error message)
+    '''
+    try:
+        return _generate(*job)
+    except (ValueError,TypeError,KeyError,IndexError) as e:
+        return (None,'Invalid request: ' + str(e))
+    except Exception as e:
+        return (None,'Generation failed: ' + str(e))
+
+def _is_int(value):
+    '''
+    Returns True if value is an integer and not a boolean
+    '''
+    return isinstance(value,(int,long)) and not isinstance(value,bool)
+
+def _check_params(params):
+    '''
+    Checks the parameters of a request before it reaches a worker. Returns an
+    error message, or None if the parameters are valid
+    '''
+    if not isinstance(params,dict):
+        return 'Request must be a JSON object'
+
+    if params.get('melody') != None:
+        melody = params['melody']
+        if (not isinstance(melody,list)) or (len(melody) == 0) or (len(melody) > MAX_LENGTH):
+            return 'Melody must be a list of 1 to ' + str(MAX_LENGTH) + ' notes'
+        for x in melody:
+            if (not isinstance(x,list)) or (len(x) != 2) or (not _is_int(x[0])) or (not _is_int(x[1])):
+                return 'Melody notes must be [pitch,duration] integers'
+            if (x[0] != bach.REST_MIDI) and ((x[0] < 0) or (x[0] > 127)):
+                return 'Pitch out of range: ' + str(x[0])
+            if x[1] <= 0:
+                return 'Duration must be positive: ' + str(x[1])
+    elif params.get('length') == None:
+        return 'A length or a melody is needed'
+    elif (not _is_int(params['length'])) or (params['length'] < 1) or (params['length'] > MAX_LENGTH):
+        return 'Length must be an integer from 1 to ' + str(MAX_LENGTH)
+
+    if params.get('format','events') not in ['events','midi']:
+        return 'Unknown format: ' + str(params.get('format'))
+    if (params.get('seed') != None) and (not _is_int(params['seed'])):
+        return 'Seed must be an integer'
+
+    return None
+
+def _generate(kind,model_name,params,seed):
+    model = _worker_models[model_name]
+    random.seed(seed)
+
+    if params.get('melody') != None:
+        melody = [(int(x[0]),int(x[1])) for x in params['melody']]
+    else:
+        melody = list(bach.iter_melody(model,int(params['length'])))
+
+    if kind == 'melody':
+        events = bach.melody_to_events([x[0] for x in melody],[x[1] for x in melody])
+    else:
+        harmony = list(bach.iter_harmony(model,melody,len(melody)))
+        if len(harmony) < len(melody):
+            return (None,'Unable to realize harmony with given melody')
+        events = bach.harmony_to_events(harmony,smooth=True)
+
+    response = {'seed':seed}
+    if params.get('format','events') == 'midi':
+        response['midi'] = base64.b64encode(bach.events_to_midi(events)).decode('ascii')
+    else:
+        response['events'] = [list(x) for x in events]
+
+    return (response,None)
+
+class generation_server(ThreadingMixIn,HTTPServer):
+    '''
+    An HTTP server generating music from models kept in memory
+
+    INPUTS:
+        models: dictionary of model name to model
+        port: port to listen on, 0 for any free port
+        workers: number of worker processes. If workers == 0 the music is
+                 generated in the server process
+        host: address to listen on
+
+    Request handler threads queue jobs. A dispatcher thread takes every job
+    waiting, up to MAX_BATCH_SIZE, and runs them on the pool in one batch
+    '''
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self,models,port=SERVER_PORT,workers=1,host=SERVER_HOST):
+        HTTPServer.__init__(self,(host,port),_request_handler)
+        self.models = models
+        self.jobs = Queue()
+        self.seeds = random.Random()
+
+        if workers > 0:
+            self.pool = multiprocessing.Pool(workers,_init_worker,(models,))
+        else:
+            _init_worker(models)
+            self.pool = None
+
+        self.dispatcher = threading.Thread(target=self._dispatch)
+        self.dispatcher.daemon = True
+        self.dispatcher.start()
+
+    def generate(self,kind,params):
+        '''
+        Generates the music of a request and returns (response,None) or
+        (None,error message)
+        '''
+        error = _check_params(params)
+        if error != None:
+            return (None,error)
+
+        model_name = params.get('model')
+        if (model_name == None) and (len(self.models) == 1):
+            model_name = list(self.models.keys())[0]
+        if (not isinstance(model_name,basestring)) or (model_name not in self.models):
+            return (None,'Unknown model: ' + str(model_name))
+
+        seed = params.get('seed')
+        if seed == None:
+            seed = self.seeds.randint(0,MAX_SEED)
+
+        job = {'job':(kind,model_name,params,seed),'done':threading.Event(),'result':None}
+        self.jobs.put(job)
+        job['done'].wait()
+
+        return job['result']
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self.jobs.put(None)
+        if self.pool != None:
+            self.pool.terminate()
+            self.pool.join()
+
+    def _dispatch(self):
+        while True:
+            batch = [self.jobs.get()]
+            deadline = time.time() + BATCH_WAIT
+
+            while (len(batch) < MAX_BATCH_SIZE) and (batch[-1] != None):
+                try:
+                    batch.append(self.jobs.get(timeout=max(0,deadline - time.time())))
+                except Empty:
+                    break
+
+            if batch[-1] == None:
+                return
+
+            try:
+                if self.pool != None:
+                    results = self.pool.map(_run_job,[x['job'] for x in batch])
+                else:
+                    results = [_run_job(x['job']) for x in batch]
+            except Exception as e:
+                results = [(None,'Generation failed: ' + str(e))]*len(batch)
+
+            for (job,result) in zip(batch,results):
+                job['result'] = result
+                job['done'].set()
+
+class _request_handler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path == '/models':
+            self._respond(200,{'models':sorted(self.server.models.keys())})
+        else:
+            self._respond(404,{'error':'Unknown path: ' + self.path})
+
+    def do_POST(self):
+        if self.path not in ['/melody','/harmony']:
+            self._respond(404,{'error':'Unknown path: ' + self.path})
+            return
+
+        try:
+            length = int(self.headers.get('Content-Length',0))
+            params = json.loads(self.rfile.read(length).decode('utf-8'))
+        except ValueError:
+            self._respond(400,{'error':'Request is not valid JSON'})
+            return
+
+        (response,error) = self.server.generate(self.path[1:],params)
+
+        if error != None:
+            self._respond(400,{'error':error})
+        else:
+            self._respond(200,response)
+
+    def log_message(self,format,*args):
+        pass
+
+    def _respond(self,status,response):
+        body = json.dumps(response).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type','application/json')
+        self.send_header('Content-Length',str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serves music generated from saved models')
+    parser.add_argument('models',nargs='+',help='models to serve as name=filename')
+    parser.add_argument('--port',type=int,default=SERVER_PORT)
+    parser.add_argument('--workers',type=int,default=multiprocessing.cpu_count())
+    args = parser.parse_args()
+
+    models = load_models(dict([x.split('=',1) for x in args.models]))
+    if models == None:
+        sys.exit(1)
+
+    server = generation_server(models,args.port,args.workers)
+    print 'Serving on ' + SERVER_HOST + ':' + str(server.server_port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
@@ -0,0 +1,232 @@
+'''
+Benchmarks of the hot paths of bach.py
+
+The benchmarks run on a small synthetic corpus of four part chorales bundled
+below, so they need neither a network connection nor the music21 chorale
+corpus. Every benchmark is seeded so repeated runs do the same work.
+
+USAGE:
+    python bench_bach.py [-o results.json] [-c baseline.json] [-q]
+
+    -o writes the results as JSON, -c compares the results with those of an
+    earlier run and -q runs fewer repeats
+'''
+import sys
+import json
+import random
+import argparse
+import platform
+import subprocess
+from array import array
+from timeit import default_timer
+from music21 import *
+
+import bach
+
+'''
+CONSTANTS
+'''
+BENCH_SEED = 1685
+BENCH_ORDERS = (2,3,2)
+MELODY_LENGTHS = [8,16,32]
+REGRESSION_THRESHOLD = 0.10
+
+# Phrases of the synthetic corpus in C major. Each chord is
+# (quarter length,bass,tenor,alto,soprano) in midi numbers, where the
+# soprano may be a pair of eighth notes
+PHRASES = [
+    [(1,48,55,64,72),(1,53,57,65,72),(1,55,59,67,74),(1,48,55,64,72),
+     (1,45,57,64,72),(1,50,57,65,74),(1,43,55,62,71),(2,48,55,64,72)],
+    [(1,48,52,67,76),(1,50,53,69,77),(1,52,55,71,79),(1,53,57,72,77),
+     (1,55,59,74,79),(1,57,60,72,76),(1,55,62,71,74),(2,48,55,64,72)],
+    [(1,48,55,67,76),(1,53,60,69,(77,76)),(1,50,57,65,74),(1,55,59,67,(74,72)),
+     (1,45,60,64,69),(1,53,57,65,72),(1,55,59,62,71),(2,48,52,67,72)],
+    [(1,45,57,64,72),(1,52,56,64,71),(1,45,57,64,69),(1,50,57,65,72),
+     (1,55,59,65,74),(1,48,55,64,72),(1,53,60,65,69),(2,55,59,67,74)],
+]
+TRANSPOSITIONS = [0,2,-3]
+
+'''
+PUBLIC FUNCTIONS
+'''
+def gen_corpus():
+    '''
+    Returns the synthetic corpus as a list of music21 Scores with parts named
+    'Soprano', 'Alto', 'Tenor' and 'Bass' like the chorales in music21. Each
+    chorale is every phrase in a rotated order, transposed to another key
+    '''
+    chorales = []
+
+    for transposition in TRANSPOSITIONS:
+        for rotation in range(len(PHRASES)):
+            chords = []
+            for phrase in PHRASES[rotation:] + PHRASES[:rotation]:
+                chords.extend(phrase)
+            chorales.append(_chords_to_score(chords,transposition))
+
+    return chorales
+
+def run_benchmarks(repeat=5):
+    '''
+    Runs every benchmark and returns the results as a dictionary keyed by
+    benchmark name. Each result holds the best and mean time in seconds of
+    one call over repeat runs, and may hold counts recorded by the benchmark
+    '''
+    chorales = gen_corpus()
+    features = [bach._extract_features(s) for s in chorales]
+    model = bach.chorale_model(*BENCH_ORDERS)
+    for chorale_features in features:
+        model.add_features_to_model(chorale_features)
+
+    results = {}
+
+    def ingest():
+        m = bach.chorale_model(*BENCH_ORDERS)
+        for s in chorales:
+            m.add_chorale_to_model(s)
+    results['ingest_chorale'] = _time(ingest,max(1,repeat//2),len(chorales))
+
+    sequences = [x['melody_pitches'] for x in features] + [x['chords'] for x in features]
+    def update_markov():
+        markov_model = {}
+        for data in sequences:
+            bach._update_markov(list(data),markov_model,BENCH_ORDERS[1])
+    results['update_markov'] = _time(update_markov,repeat,len(sequences))
+
+    model_states = list(model.melody_pitch_model.values())*20
+    def get_next_element():
+        for model_state in model_states:
+            bach._get_next_element(model_state)
+    results['get_next_element'] = _time(get_next_element,repeat,len(model_states))
+
+    for melody_len in MELODY_LENGTHS:
+        results['gen_melody_' + str(melody_len)] = _time(lambda: bach.gen_melody(model,melody_len),repeat,1)
+
+    melodies = []
+    for i in range(10):
+        melodies.append(bach.gen_melody(model,MELODY_LENGTHS[-1]))
+    counts = {'attempts':0,'failures':0}
+    def gen_harmony():
+        for melody in melodies:
+            counts['attempts'] += 1
+            if bach.gen_harmony(melody,model) == None:
+                counts['failures'] += 1
+    results['gen_harmony'] = _time(gen_harmony,repeat,len(melodies))
+    results['gen_harmony']['retry_rate'] = float(counts['failures'])/counts['attempts']
+
+    voice_pitches = [array('h'),array('h'),array('h')]
+    voice_durations = [array('i'),array('i'),array('i')]
+    for i in range(20):
+        for s in chorales:
+            for voice in [bach.BASS,bach.ALTO,bach.TENOR]:
+                for n in s.parts[3-voice].flat.notes:
+                    voice_pitches[voice].append(n.pitch.midi)
+                    voice_durations[voice].append(int(n.quarterLength*bach.TICKS_PER_QUARTER))
+    results['smooth_harmony'] = _time(lambda: bach._smooth_harmony(voice_pitches,voice_durations),repeat,1)
+    results['smooth_harmony']['notes'] = len(voice_pitches[0])
+
+    return results
+
+def compare_results(results,baseline,threshold=REGRESSION_THRESHOLD):
+    '''
+    Prints the best time of each benchmark against that of a baseline run
+    and returns the names of the benchmarks more than threshold slower
+    '''
+    regressions = []
+
+    for name in sorted(results.keys()):
+        if name not in baseline:
+            print '%-20s %12.6f %12s' % (name,results[name]['best'],'-')
+            continue
+
+        ratio = results[name]['best']/baseline[name]['best']
+        flag = ''
+        if ratio > 1 + threshold:
+            flag = 'SLOWER'
+            regressions.append(name)
+        elif ratio < 1 - threshold:
+            flag = 'faster'
+        print '%-20s %12.6f %12.6f %7.2fx %s' % (name,results[name]['best'],baseline[name]['best'],ratio,flag)
+
+    return regressions
+
+'''
+PRIVATE FUNCTIONS
+'''
+def _chords_to_score(chords,transposition):
+    '''
+    Returns a four part Score of a list of chords (see PHRASES)
+    '''
+    score = stream.Score()
+
+    for (voice,part_name) in reversed(list(enumerate(bach.VOICE_NAMES))):
+        part = stream.Part()
+        part.id = part_name
+
+        for chord_notes in chords:
+            notes = chord_notes[voice+1]
+            if isinstance(notes,tuple):
+                ql = float(chord_notes[0])/len(notes)
+            else:
+                (notes,ql) = ((notes,),chord_notes[0])
+
+            for midi in notes:
+                n = note.Note(midi + transposition)
+                n.quarterLength = ql
+                part.append(n)
+
+        score.insert(0,part)
+
+    return score
+
+def _time(func,repeat,number):
+    '''
+    Calls func repeat times with a fixed seed and returns the best and mean
+    time of each of the number operations done by one call
+    '''
+    times = []
+
+    for i in range(repeat):
+        random.seed(BENCH_SEED)
+        start = default_timer()
+        func()
+        times.append((default_timer() - start)/number)
+
+    return {'best':min(times),'mean':sum(times)/len(times),'repeat':repeat,'number':number}
+
+def _get_commit():
+    try:
+        return subprocess.check_output(['git','rev-parse','HEAD'],stderr=subprocess.STDOUT).decode('ascii').strip()
+    except (OSError,subprocess.CalledProcessError):
+        return None
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks of bach.py on a synthetic corpus')
+    parser.add_argument('-o','--output',help='file the results are written to as JSON')
+    parser.add_argument('-c','--compare',help='JSON results of an earlier run to compare with')
+    parser.add_argument('-q','--quick',action='store_true',help='run fewer repeats')
+    args = parser.parse_args()
+
+    if args.quick:
+        results = run_benchmarks(repeat=2)
+    else:
+        results = run_benchmarks()
+
+    run = {'commit':_get_commit(),
+           'python':platform.python_version(),
+           'music21':base.VERSION_STR,
+           'seed':BENCH_SEED,
+           'results':results}
+
+    if args.output:
+        output = open(args.output,'w')
+        json.dump(run,output,indent=2,sort_keys=True)
+        output.close()
+
+    if args.compare:
+        baseline = json.load(open(args.compare))
+        if compare_results(results,baseline['results']):
+            sys.exit(1)
+    else:
+        for name in sorted(results.keys()):
+            print '%-20s %12.6f %12.6f' % (name,results[name]['best'],results[name]['mean'])